@@ -0,0 +1,131 @@
+#!/usr/bin/env python
+"""
+Benchmark of the eth_nios read-out paths, against a local stand-in for the
+NIOS server.
+
+Compares the legacy hex-string transfer (read_nios, hex decoding and
+struct.unpack into a tuple) with the binary transfer into a preallocated
+int32 buffer (read_nios_into), both opening a new connection per read, and
+the persistent connections of Probe.read(), reporting samples/s.
+
+Then compares sequential and concurrent dual-channel reads through
+Probe.read(), with the server paced at the ADC sample rate.
+
+Build the C library first:
+    cd dualscope123/probes && sh compile_ethc_binding.sh
+then run:
+    PYTHONPATH=. python benchmarks/eth_nios_read.py
+"""
+import os
+import SocketServer
+import struct
+import tempfile
+import threading
+import time
+
+import numpy as np
+
+from dualscope123.probes import eth_nios
+
+CHUNK = 350
+
+def nios_words(nsamples):
+    """Big-endian words as sent by the NIOS server, with a valid payload
+    counter so that no dropped packets are reported."""
+    i = np.arange(nsamples, dtype=np.uint32)
+    words = ((i % 64) << 21) | (i % 1024)
+    return words.astype('>u4').tostring()
+
+class NiosHandler(SocketServer.BaseRequestHandler):
+    # if set, the replies are paced as if sampled at this rate
+    rate = None
+
+    def handle(self):
+        while True:
+            command = ''
+            while len(command) < 4:
+                data = self.request.recv(4 - len(command))
+                if not data:
+                    return
+                command += data
+            nchunks = struct.unpack('>I', '\x00' + command[1:])[0]
+            if self.rate:
+                time.sleep(nchunks*CHUNK/float(self.rate))
+            self.request.sendall(nios_words(nchunks*CHUNK))
+
+class NiosServer(SocketServer.ThreadingTCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+def read_hex(port, nchunks):
+    x = eth_nios._libfunctions.read_nios('localhost', port, 0, nchunks)
+    return np.array(struct.unpack('<'+('i'*nchunks*CHUNK), x.decode('hex')))
+
+def read_binary(port, nchunks, out):
+    n = eth_nios._libfunctions.read_nios_into('localhost', port, 0, nchunks, out)
+    assert n == nchunks*CHUNK
+    return out
+
+def bench(func, args, repeat):
+    start = time.time()
+    for _ in range(repeat):
+        func(*args)
+    return time.time() - start
+
+def make_probe(port):
+    """A Probe configured for the local server through a temporary HOME."""
+    home = tempfile.mkdtemp()
+    with open(os.path.join(home, '.dualscope123'), 'w') as fp:
+        fp.write("[eth_nios]\nhostname = localhost\nport = %d\n" % port)
+    old_home = os.environ.get('HOME')
+    os.environ['HOME'] = home
+    try:
+        probe = eth_nios.Probe()
+        probe.open()
+    finally:
+        os.environ['HOME'] = old_home
+    return probe
+
+def read_sequential(probe, nchunks):
+    return [probe.read(c, nchunks*CHUNK) for c in (1, 2)]
+
+def main():
+    server = NiosServer(('localhost', 0), NiosHandler)
+    port = server.server_address[1]
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+
+    print "Read-out of one channel:"
+    probe = make_probe(port)
+    print "%8s %16s %16s %16s" % ("chunks", "hex [S/s]", "binary [S/s]",
+                                  "persistent [S/s]")
+    for nchunks in (1, 10, 100, 1000):
+        repeat = max(2, 2000/nchunks)
+        out = np.empty((nchunks*CHUNK,), dtype=np.int32)
+        assert np.all(read_hex(port, nchunks) == read_binary(port, nchunks, out))
+        assert np.all(probe.read(1, nchunks*CHUNK)[0] == out)
+        t_hex = bench(read_hex, (port, nchunks), repeat)
+        t_bin = bench(read_binary, (port, nchunks, out), repeat)
+        t_per = bench(probe.read, (1, nchunks*CHUNK), repeat)
+        nsamples = float(repeat*nchunks*CHUNK)
+        print "%8d %16.3g %16.3g %16.3g" % (nchunks, nsamples/t_hex,
+                                            nsamples/t_bin, nsamples/t_per)
+    probe.close()
+
+    print
+    print "Dual channel read-out, server paced at %d S/s:" % (eth_nios.Probe().RATE,)
+    NiosHandler.rate = eth_nios.Probe().RATE
+    probe = make_probe(port)
+    print "%8s %16s %16s %8s" % ("chunks", "sequential [s]", "concurrent [s]", "skew [s]")
+    for nchunks in (1, 10, 100):
+        repeat = max(2, 100/nchunks)
+        t_seq = bench(read_sequential, (probe, nchunks), repeat)/repeat
+        t_con = bench(probe.read, ('12', nchunks*CHUNK), repeat)/repeat
+        print "%8d %16.3g %16.3g %8.2g" % (nchunks, t_seq, t_con,
+                                          probe.stats['start_skew'])
+    probe.close()
+    server.shutdown()
+
+if __name__ == '__main__':
+    main()
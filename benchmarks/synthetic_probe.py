@@ -0,0 +1,49 @@
+#!/usr/bin/env python
+"""
+Throughput of the synthetic probe, on its own and feeding the acquisition
+engine, with realtime pacing disabled.
+
+    PYTHONPATH=. python benchmarks/synthetic_probe.py
+"""
+import time
+
+import numpy as np
+
+from dualscope123 import acquisition
+from dualscope123.probes import synthetic
+
+def make_probe(rate, channels, chunk):
+    probe = synthetic.Probe()
+    probe.RATE, probe.CHANNELS, probe.CHUNK = rate, channels, chunk
+    probe.REALTIME = False
+    probe.setup()
+    return probe
+
+def main():
+    print "%10s %8s %8s %16s %16s" % ("rate", "channels", "chunk",
+                                      "probe [S/s/ch]", "engine [S/s/ch]")
+    for rate, channels in ((1000000, 2), (10000000, 2), (1000000, 8)):
+        for chunk in (4096, 65536):
+            probe = make_probe(rate, channels, chunk)
+            buffers = np.empty((channels, chunk), dtype=probe.DTYPE)
+            nblocks = max(10, 2**24/chunk/channels)
+            start = time.time()
+            for _ in range(nblocks):
+                probe.read_into(buffers)
+            t_probe = time.time() - start
+
+            engine = acquisition.Acquisition(probe, depth=1.0)
+            # opening re-reads the configuration, bypass it
+            probe.open = lambda: None
+            engine.open()
+            start = time.time()
+            time.sleep(1.0)
+            written = engine.ring.written
+            t_engine = time.time() - start
+            engine.close()
+            print "%10d %8d %8d %16.3g %16.3g" % (rate, channels, chunk,
+                                                  nblocks*chunk/t_probe,
+                                                  written/t_engine)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,60 @@
+#!/usr/bin/env python
+"""
+Throughput of the pure-Python tcp probe against its local simulator, for
+several block sizes and pipeline depths. No hardware or C library needed.
+
+    PYTHONPATH=. python benchmarks/tcp_probe.py
+"""
+import os
+import tempfile
+import threading
+import time
+
+import numpy as np
+
+from dualscope123.probes import tcp
+
+RATE = 1000000
+CHANNELS = 2
+
+def make_probe(port, chunk, pipeline):
+    """A Probe configured for the local simulator through a temporary HOME."""
+    home = tempfile.mkdtemp()
+    with open(os.path.join(home, '.dualscope123'), 'w') as fp:
+        fp.write("[tcp]\nhostname = localhost\nport = %d\nchunk = %d\n"
+                 "pipeline = %d\n" % (port, chunk, pipeline))
+    old_home = os.environ.get('HOME')
+    os.environ['HOME'] = home
+    try:
+        probe = tcp.Probe()
+        probe.open()
+    finally:
+        os.environ['HOME'] = old_home
+    return probe
+
+def main():
+    server = tcp.Simulator(('localhost', 0), RATE, CHANNELS)
+    port = server.server_address[1]
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+
+    print "%8s %8s %16s" % ("chunk", "pipeline", "rate [S/s/ch]")
+    for chunk in (256, 4096, 65536):
+        for pipeline in (1, 2, 4, 8):
+            probe = make_probe(port, chunk, pipeline)
+            buffers = np.empty((CHANNELS, chunk), dtype=np.int32)
+            # consecutive reads must be consecutive in time
+            first = probe.read('12', chunk + 10)[0]
+            assert np.all(first == server.table[0, :chunk + 10])
+            nblocks = max(4, 2**22/chunk/CHANNELS)
+            start = time.time()
+            for _ in range(nblocks):
+                probe.read_into(buffers)
+            elapsed = time.time() - start
+            probe.close()
+            print "%8d %8d %16.3g" % (chunk, pipeline, nblocks*chunk/elapsed)
+    server.shutdown()
+
+if __name__ == '__main__':
+    main()
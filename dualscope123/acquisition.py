@@ -0,0 +1,243 @@
+"""
+Background acquisition engine.
+
+The probe is read continuously in a dedicated thread and every block it
+returns is copied into a preallocated, per-channel ring buffer. The GUI
+timers do not talk to the probe anymore: they pull the newest frame out of
+the ring buffer, which returns immediately.
+
+The Acquisition object exposes the same open/read/close interface as a
+probe, so that it can be handed to the scope widgets in place of one.
+"""
+import threading
+import time
+
+import numpy as np
+
+from .probes import generic
+
+# seconds of history kept in the ring buffer, by default
+DEFAULT_DEPTH = 4.0
+
+class RingBuffer(object):
+    """
+    Single-producer, multi-consumer ring buffer of multi-channel samples.
+
+    The samples live in a preallocated (channels, size) array. There are no
+    locks: the writer announces the region it is about to overwrite, copies
+    the block in and only then publishes the new sample count. A reader
+    copies the samples out and afterwards checks that the writer did not
+    reach them in the meantime, in which case the read is discarded.
+    """
+    def __init__(self, channels, size, dtype=np.int32):
+        self.channels = channels
+        self.size = size
+        self.dtype = np.dtype(dtype)
+        self.data = np.zeros((channels, size), dtype=self.dtype)
+        self.written = 0L     # samples published so far
+        self._writing = 0L    # samples written once the current copy is done
+
+    def write(self, block):
+        """Append a (channels, n) block, n <= size."""
+        n = block.shape[1]
+        if n > self.size:
+            raise ValueError("Block of %d samples exceeds the ring buffer "
+                             "size (%d)." % (n, self.size))
+        start = self.written % self.size
+        first = min(n, self.size - start)
+        self._writing = self.written + n
+        self.data[:, start:start+first] = block[:, :first]
+        self.data[:, :n-first] = block[:, first:]
+        self.written = self._writing
+
+    def reserve(self, n):
+        """Return a writable (channels, n) view of the next n slots.
+
+        Lets a probe fill the ring buffer in place; commit() publishes the
+        samples. Returns None if the slots wrap around the end of the
+        buffer, use write() then.
+        """
+        start = self.written % self.size
+        if start + n > self.size:
+            return None
+        self._writing = self.written + n
+        return self.data[:, start:start+n]
+
+    def commit(self, n):
+        """Publish n samples written into the view returned by reserve()."""
+        self.written += n
+        self._writing = self.written
+
+    def read(self, start, n, out=None):
+        """Copy the samples [start, start+n) of the stream into out.
+
+        Returns out (allocated if None), or None if the samples are not
+        available -- not acquired yet or already overwritten.
+        """
+        if n > self.size or start < 0 or start + n > self.written:
+            return None
+        if self._writing - start > self.size:
+            return None
+        if out is None:
+            out = np.empty((self.channels, n), dtype=self.dtype)
+        i = start % self.size
+        first = min(n, self.size - i)
+        out[:, :first] = self.data[:, i:i+first]
+        out[:, first:] = self.data[:, :n-first]
+        # the writer may have lapped us while copying
+        if self._writing - start > self.size:
+            return None
+        return out
+
+    def latest(self, n, out=None):
+        """Copy the newest n samples into out, see read()."""
+        # retry if the writer laps the reader, it can only happen when n is
+        # close to the buffer size
+        for _ in range(3):
+            frame = self.read(self.written - n, n, out)
+            if frame is not None:
+                return frame
+        return None
+
+class Acquisition(object):
+    """
+    Run a probe in a background thread, feeding a RingBuffer.
+
+    read(channel, npoints, verbose) has the same signature and return
+    values as Probe.read(), but it returns the newest npoints samples
+    already in memory instead of waiting for the probe.
+    """
+    def __init__(self, probe, depth=DEFAULT_DEPTH, verbose=False):
+        self.probe = probe
+        self.depth = depth
+        self.verbose = verbose
+        self.ring = None
+        self.errors = 0
+        self._sinks = []
+        self._stop = threading.Event()
+        self._thread = None
+
+    def add_sink(self, sink):
+        """Call sink(block) with every (channels, n) block acquired.
+
+        The sinks are called from the acquisition thread and must not
+        block; the block is only valid during the call.
+        """
+        self._sinks = self._sinks + [sink]
+
+    def remove_sink(self, sink):
+        self._sinks = [s for s in self._sinks if s != sink]
+
+    def open(self):
+        # some probes only know their rate and channels once open
+        self.probe.open()
+        self.RATE = self.probe.RATE
+        self.CHUNK = self.probe.CHUNK
+        self.CHANNELS = self.probe.CHANNELS
+        self.FORMAT = self.probe.FORMAT
+        self.caps = generic.capabilities(self.probe)
+        self.DTYPE = self.caps['dtype']
+        # one more block, as the one being written is not readable
+        size = max(int(self.depth*self.RATE), self.CHUNK) + self.CHUNK
+        self.ring = RingBuffer(self.CHANNELS, size, self.DTYPE)
+        if self.caps['api_version'] >= 2:
+            self._scratch = np.empty((self.CHANNELS, self.CHUNK),
+                                     dtype=self.ring.dtype)
+        else:
+            self._scratch = None
+        self._channel = ''.join([str(c + 1) for c in range(self.CHANNELS)])
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run,
+                                        name='dualscope123-acquisition')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                self._read_block()
+            except Exception, e:
+                self.ring.commit(0)
+                self.errors += 1
+                print "(EE) Acquisition: probe read failed: %s" % (e,)
+                time.sleep(.1)
+
+    def _read_block(self):
+        if self._scratch is not None:
+            # the probe fills the ring buffer directly, unless the block
+            # would wrap around its end
+            view = self.ring.reserve(self.CHUNK)
+            if view is not None:
+                n = self.probe.read_into(view, self.CHUNK, self.verbose)
+                self.ring.commit(n)
+            else:
+                view = self._scratch
+                n = self.probe.read_into(view, self.CHUNK, self.verbose)
+                if n:
+                    self.ring.write(view[:, :n])
+            if not n:
+                # e.g. the end of a replay: the sinks get no empty blocks
+                return
+            block = view[:, :n]
+        else:
+            data = self.probe.read(self._channel, self.CHUNK, self.verbose)
+            if data is None:
+                return
+            if self.CHANNELS == 1:
+                data = (data,)
+            n = min([len(d) for d in data])
+            if not n:
+                return
+            block = np.vstack([d[:n] for d in data])
+            self.ring.write(block)
+        for sink in self._sinks:
+            sink(block)
+
+    @property
+    def written(self):
+        """Number of samples per channel acquired so far.
+
+        Sample i of the stream, for i < written, can be read with
+        read_at(i, n) as long as it was not overwritten. In a sink, the
+        block passed starts at written - block.shape[1].
+        """
+        return self.ring.written
+
+    @property
+    def capacity(self):
+        """The most samples per channel read_at() and latest() can return:
+        the ring buffer, less the block being written."""
+        return self.ring.size - self.CHUNK
+
+    def read_at(self, start, npoints, out=None):
+        """Return the samples [start, start+npoints) of the stream.
+
+        Returns a (channels, npoints) array, or None if the samples are not
+        in the ring buffer -- not acquired yet or already overwritten.
+        """
+        return self.ring.read(start, npoints, out)
+
+    def latest(self, npoints):
+        """Return the newest npoints samples as a (channels, npoints) array.
+
+        Returns None if they are not available yet.
+        """
+        return self.ring.latest(npoints)
+
+    def read(self, channel, npoints, verbose=False):
+        rows = [int(c) - 1 for c in str(channel)]
+        frame = self.latest(npoints)
+        if frame is None:
+            # not enough data yet
+            frame = np.zeros((self.CHANNELS, 0), dtype=self.ring.dtype)
+        if len(rows) == 1:
+            return frame[rows[0]]
+        return tuple([frame[r] for r in rows])
+
+    def close(self):
+        self._stop.set()
+        if self._thread is not None:
+            # a blocking probe read has to complete before the thread exits
+            self._thread.join(1.0)
+            self._thread = None
+        self.probe.close()
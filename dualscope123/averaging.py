@@ -0,0 +1,137 @@
+"""
+Frame averaging with preallocated accumulators.
+
+An Averager is fed frames of a constant shape, e.g. (channels, samples),
+and returns their average. The accumulators are allocated when the first
+frame arrives, or when the frame shape changes, and then updated in place:
+averaging for hours allocates no memory.
+
+Modes:
+
+ * cumulative: the mean of all the frames since the last reset,
+ * exponential: an exponential moving average with a time constant of
+   'frames' frames. Until 'frames' frames are seen it is the cumulative
+   mean, so that it does not start biased towards the first frame.
+ * boxcar: the mean of the last 'frames' frames, kept in a ring.
+"""
+import numpy as np
+
+CUMULATIVE, EXPONENTIAL, BOXCAR = 'cumulative', 'exponential', 'boxcar'
+MODES = (CUMULATIVE, EXPONENTIAL, BOXCAR)
+
+DEFAULT_FRAMES = 16
+
+class Averager(object):
+    def __init__(self, mode=CUMULATIVE, frames=DEFAULT_FRAMES):
+        if mode not in MODES:
+            raise ValueError("Unknown averaging mode '%s'." % (mode,))
+        self.mode = mode
+        self.frames = max(int(frames), 1)
+        self.count = 0           # frames in the average
+        self.shape = None
+        self.mean = None         # the average, returned by add()
+        self._sum = None         # cumulative and boxcar modes
+        self._ring = None        # boxcar mode, last frames
+        self._index = 0          # boxcar mode, next slot of the ring
+        self._tmp = None         # exponential mode, scratch
+
+    def reset(self):
+        """Forget the frames added so far."""
+        self.count = 0
+        self._index = 0
+        # the boxcar sum is updated incrementally: it must restart at zero
+        if self._sum is not None:
+            self._sum.fill(0.)
+        if self._ring is not None:
+            self._ring.fill(0.)
+
+    def setMode(self, mode, frames=None):
+        if mode not in MODES:
+            raise ValueError("Unknown averaging mode '%s'." % (mode,))
+        self.mode = mode
+        if frames is not None:
+            self.frames = max(int(frames), 1)
+        # reallocate on the next frame
+        self.shape = None
+        self.reset()
+
+    def _allocate(self, shape):
+        self.shape = shape
+        self.mean = np.zeros(shape)
+        self._sum = np.zeros(shape) if self.mode != EXPONENTIAL else None
+        self._tmp = np.zeros(shape) if self.mode == EXPONENTIAL else None
+        self._ring = np.zeros((self.frames,) + shape) \
+                     if self.mode == BOXCAR else None
+        self.reset()
+
+    def add(self, frame):
+        """Add a frame, return the average.
+
+        The average is a preallocated array, overwritten by the next call:
+        copy it to keep it.
+        """
+        if frame.shape != self.shape:
+            self._allocate(frame.shape)
+        if self.mode == CUMULATIVE:
+            if self.count:
+                self._sum += frame
+            else:
+                self._sum[...] = frame
+            self.count += 1
+            np.multiply(self._sum, 1.0/self.count, out=self.mean)
+        elif self.mode == EXPONENTIAL:
+            self.count += 1
+            weight = 1.0/min(self.count, self.frames)
+            # mean += weight*(frame - mean)
+            np.subtract(frame, self.mean, out=self._tmp)
+            self._tmp *= weight
+            self.mean += self._tmp
+        else:
+            slot = self._ring[self._index]
+            if self.count == self.frames:
+                self._sum -= slot
+            else:
+                self.count += 1
+            slot[...] = frame
+            self._index = (self._index + 1) % self.frames
+            if self._index == 0:
+                # recompute the sum once per turn of the ring, so that the
+                # rounding errors of the subtractions do not accumulate
+                self._ring[:self.count].sum(axis=0, out=self._sum)
+            else:
+                self._sum += slot
+            np.multiply(self._sum, 1.0/self.count, out=self.mean)
+        return self.mean
+
+def test_averager():
+    frames = np.random.rand(50, 2, 100)
+    a = Averager(CUMULATIVE)
+    for i in range(50):
+        mean = a.add(frames[i])
+    assert np.allclose(mean, frames.mean(axis=0))
+    a = Averager(BOXCAR, 8)
+    for i in range(50):
+        mean = a.add(frames[i])
+        assert np.allclose(mean, frames[max(0, i - 7):i+1].mean(axis=0))
+    a = Averager(EXPONENTIAL, 4)
+    expected = frames[0].copy()
+    for i in range(50):
+        mean = a.add(frames[i])
+        if i:
+            w = 1.0/min(i + 1, 4)
+            expected = expected + w*(frames[i] - expected)
+        assert np.allclose(mean, expected)
+    # no reallocation
+    assert a.add(frames[0]) is mean
+    a.reset()
+    assert np.allclose(a.add(frames[3]), frames[3])
+    # nothing from before a reset is left in the boxcar sum
+    a = Averager(BOXCAR, 8)
+    for i in range(5):
+        a.add(np.full((2, 100), 10.))
+    a.reset()
+    for i in range(12):
+        assert np.all(a.add(np.zeros((2, 100))) == 0)
+
+if __name__ == '__main__':
+    test_averager()
@@ -0,0 +1,146 @@
+"""
+Peak detection: min/max envelope of every acquired sample.
+
+The PeakDetector is an Acquisition sink. It cuts the stream in frames of
+'length' samples, each made of 'buckets' buckets -- typically one per
+pixel column of the scope -- and keeps the minimum and the maximum of
+every bucket, so that a one-sample glitch survives however long the
+timebase. The blocks are reduced as they arrive, with vectorized
+reductions over whole buckets, which keeps up with the full probe rate.
+
+fetch() returns the envelope of all the frames completed since the
+previous call: samples acquired between two redraws are not skipped.
+"""
+import threading
+
+import numpy as np
+
+class PeakDetector(object):
+    def __init__(self, channels, dtype=np.int32):
+        self.channels = channels
+        self.dtype = np.dtype(dtype)
+        self.length = 0          # samples per frame
+        self.size = 0            # samples per bucket
+        self.buckets = 0         # buckets per frame
+        self.frames = 0L         # frames completed
+        self._bucket = 0         # bucket being filled
+        self._offset = 0         # samples already in it
+        self._min = self._max = None       # frame being filled
+        self._pmin = self._pmax = None     # frames completed, not fetched
+        self._pending = 0
+        self._lock = threading.Lock()
+
+    def configure(self, length, buckets):
+        """Frames of length samples, reduced to at most buckets buckets."""
+        size = max(-(-int(length)//int(buckets)), 1)
+        buckets = -(-int(length)//size)
+        if (length, size, buckets) == (self.length, self.size, self.buckets):
+            return
+        with self._lock:
+            self.length, self.size, self.buckets = length, size, buckets
+            shape = (self.channels, buckets)
+            if np.issubdtype(self.dtype, np.integer):
+                info = np.iinfo(self.dtype)
+            else:
+                info = np.finfo(self.dtype)
+            self._top, self._bottom = info.max, info.min
+            self._min = np.empty(shape, self.dtype)
+            self._max = np.empty(shape, self.dtype)
+            self._pmin = np.empty(shape, self.dtype)
+            self._pmax = np.empty(shape, self.dtype)
+            self._clear()
+            self._pending = 0
+
+    def disable(self):
+        with self._lock:
+            self.length = self.size = self.buckets = 0
+
+    def _clear(self):
+        self._min.fill(self._top)
+        self._max.fill(self._bottom)
+        self._bucket = 0
+        self._offset = 0
+
+    def __call__(self, block):
+        """Reduce a (channels, n) block, see Acquisition.add_sink()."""
+        with self._lock:
+            if not self.buckets:
+                return
+            n = block.shape[1]
+            # the last bucket of a frame may be shorter than the others
+            last = self.length - (self.buckets - 1)*self.size
+            i = 0
+            while i < n:
+                b = self._bucket
+                size = self.size if b < self.buckets - 1 else last
+                if self._offset:
+                    # complete the bucket started by the previous block
+                    k = min(size - self._offset, n - i)
+                    chunk = block[:, i:i+k]
+                    np.minimum(self._min[:, b], chunk.min(axis=1), self._min[:, b])
+                    np.maximum(self._max[:, b], chunk.max(axis=1), self._max[:, b])
+                    self._offset += k
+                    i += k
+                else:
+                    # whole buckets at once
+                    full = min((n - i)//self.size, self.buckets - 1 - b)
+                    if full:
+                        body = block[:, i:i+full*self.size]
+                        body = body.reshape(self.channels, full, self.size)
+                        body.min(axis=2, out=self._min[:, b:b+full])
+                        body.max(axis=2, out=self._max[:, b:b+full])
+                        self._bucket += full
+                        i += full*self.size
+                    else:
+                        k = min(size, n - i)
+                        self._min[:, b] = block[:, i:i+k].min(axis=1)
+                        self._max[:, b] = block[:, i:i+k].max(axis=1)
+                        self._offset = k
+                        i += k
+                if self._offset == size:
+                    self._bucket += 1
+                    self._offset = 0
+                if self._bucket == self.buckets:
+                    self._publish()
+
+    def _publish(self):
+        if self._pending:
+            np.minimum(self._pmin, self._min, self._pmin)
+            np.maximum(self._pmax, self._max, self._pmax)
+        else:
+            self._pmin[...] = self._min
+            self._pmax[...] = self._max
+        self._pending += 1
+        self.frames += 1
+        self._clear()
+
+    def fetch(self):
+        """Return the (mins, maxs) envelope of the frames completed since
+        the last call, as two (channels, buckets) arrays, or None."""
+        with self._lock:
+            if not self._pending:
+                return None
+            self._pending = 0
+            return self._pmin.copy(), self._pmax.copy()
+
+def test_peakdetector():
+    x = np.random.randint(-1000, 1000, (2, 10000)).astype(np.int32)
+    x[1, 4321] = 5000    # a glitch
+    detector = PeakDetector(2, np.int32)
+    detector.configure(1000, 64)
+    assert detector.size == 16 and detector.buckets == 63
+    # odd-sized blocks straddle buckets and frames
+    for i in range(0, 10000, 777):
+        detector(x[:, i:i+777])
+    mins, maxs = detector.fetch()
+    assert detector.frames == 10
+    frames = x.reshape(2, 10, 1000)
+    for b in range(63):
+        bucket = frames[:, :, b*16:(b+1)*16]
+        assert np.all(mins[:, b] == bucket.min(axis=2).min(axis=1))
+        assert np.all(maxs[:, b] == bucket.max(axis=2).max(axis=1))
+    assert maxs[1].max() == 5000
+    assert detector.fetch() is None
+
+if __name__ == '__main__':
+    test_peakdetector()
@@ -0,0 +1,200 @@
+"""
+FFT backends for the spectrum computations.
+
+A backend computes the FFT of the last axis of an array, with rfft(x, n)
+for real input and fft(x, n) for complex input, n being the zero-padded
+length. The backends are:
+
+ * numpy: numpy.fft, always available,
+ * scipy: scipy.fft with 'threads' workers, or scipy.fftpack on older
+   scipy releases, single threaded,
+ * fftw: pyFFTW, with 'threads' threads. A plan is made for every input
+   shape, dtype, length and transform, and the last MAX_PLANS are cached
+   by the backend instance. Plans are measured, which takes a while the
+   first time a shape is seen, unless the backend is made for realtime
+   use: then they are estimated, fast, for callers that must not stall,
+   such as the acquisition thread.
+
+get() returns a new backend instance: instances are not thread safe, each
+thread transforming data needs its own. benchmark() times the available
+backends on given shapes, to pick the fastest one for this machine.
+"""
+import collections
+import multiprocessing
+import timeit
+
+import numpy as np
+
+try:
+    import scipy.fft as scipy_fft
+    scipy_fftpack = None
+except ImportError:
+    scipy_fft = None
+    try:
+        import scipy.fftpack as scipy_fftpack
+    except ImportError:
+        scipy_fftpack = None
+
+try:
+    import pyfftw
+    import pyfftw.builders
+except ImportError:
+    pyfftw = None
+
+try:
+    DEFAULT_THREADS = multiprocessing.cpu_count()
+except NotImplementedError:
+    DEFAULT_THREADS = 1
+
+# FFTW plans cached per backend instance
+MAX_PLANS = 16
+
+class NumpyBackend(object):
+    name = 'numpy'
+    available = True
+
+    def __init__(self, threads=1, realtime=False):
+        self.threads = 1
+
+    def rfft(self, x, n):
+        return np.fft.rfft(x, n, axis=-1)
+
+    def fft(self, x, n):
+        return np.fft.fft(x, n, axis=-1)
+
+class ScipyBackend(object):
+    name = 'scipy'
+    available = scipy_fft is not None or scipy_fftpack is not None
+
+    def __init__(self, threads=1, realtime=False):
+        self.threads = threads if scipy_fft is not None else 1
+
+    def rfft(self, x, n):
+        if scipy_fft is not None:
+            return scipy_fft.rfft(x, n, axis=-1, workers=self.threads)
+        return unpack(scipy_fftpack.rfft(x, n, axis=-1), n)
+
+    def fft(self, x, n):
+        if scipy_fft is not None:
+            return scipy_fft.fft(x, n, axis=-1, workers=self.threads)
+        return scipy_fftpack.fft(x, n, axis=-1)
+
+class FFTWBackend(object):
+    name = 'fftw'
+    available = pyfftw is not None
+
+    def __init__(self, threads=1, realtime=False):
+        self.threads = threads
+        self.effort = 'FFTW_ESTIMATE' if realtime else 'FFTW_MEASURE'
+        self.plans = collections.OrderedDict()
+
+    def _plan(self, builder, dtype, x, n):
+        key = (builder, x.shape, x.dtype, n)
+        plan = self.plans.pop(key, None)
+        if plan is None:
+            template = pyfftw.empty_aligned(x.shape, dtype=dtype)
+            plan = getattr(pyfftw.builders, builder)(
+                    template, n, axis=-1, threads=self.threads,
+                    planner_effort=self.effort)
+            if len(self.plans) >= MAX_PLANS:
+                # the least recently used
+                self.plans.popitem(last=False)
+        self.plans[key] = plan
+        return plan
+
+    def rfft(self, x, n):
+        """The result is overwritten by the next call with the same plan:
+        copy it to keep it."""
+        return self._plan('rfft', np.float64, x, n)(x)
+
+    def fft(self, x, n):
+        """See rfft()."""
+        return self._plan('fft', np.complex128, x, n)(x)
+
+BACKENDS = {NumpyBackend.name: NumpyBackend,
+            ScipyBackend.name: ScipyBackend,
+            FFTWBackend.name: FFTWBackend}
+NAMES = ('numpy', 'scipy', 'fftw')
+DEFAULT_BACKEND = 'numpy'
+
+def available():
+    """Names of the backends installed."""
+    return [name for name in NAMES if BACKENDS[name].available]
+
+def get(name=DEFAULT_BACKEND, threads=None, realtime=False):
+    """Return a new instance of the backend name. With realtime, the
+    backend never spends long preparing a transform, see above."""
+    if name not in BACKENDS:
+        raise ValueError("Unknown FFT backend '%s'." % (name,))
+    if not BACKENDS[name].available:
+        raise ValueError("FFT backend '%s' is not installed." % (name,))
+    if threads is None:
+        threads = DEFAULT_THREADS
+    return BACKENDS[name](max(int(threads), 1), realtime)
+
+def benchmark(shapes, threads=None, repeat=3):
+    """Time rfft() of every available backend on random arrays of the
+    given shapes, transformed along the last axis with no padding.
+
+    Returns a list of (seconds, name), fastest first. The seconds are
+    the best of repeat runs of one FFT per shape; planning is not timed.
+    """
+    data = [np.random.randn(*shape) for shape in shapes]
+    results = []
+    for name in available():
+        backend = get(name, threads)
+        def run():
+            for x in data:
+                backend.rfft(x, x.shape[-1])
+        run()     # plans, caches
+        results.append((min(timeit.repeat(run, number=1, repeat=repeat)),
+                        name))
+    results.sort()
+    return results
+
+def unpack(y, n):
+    """Convert the packed real output of scipy.fftpack.rfft, along the
+    last axis, to the complex numpy.fft.rfft layout."""
+    out = np.zeros(y.shape[:-1] + (n//2 + 1,), dtype=np.complex128)
+    out.real[..., 0] = y[..., 0]
+    out.real[..., 1:] = y[..., 1::2]
+    im = y[..., 2::2]
+    out.imag[..., 1:1 + im.shape[-1]] = im
+    return out
+
+def test_backends():
+    x = np.random.randn(2, 1000)
+    expected = np.fft.rfft(x, 1024, axis=-1)
+    for name in available():
+        for threads in (1, 2):
+            backend = get(name, threads, realtime=threads == 2)
+            A = backend.rfft(x, 1024)
+            assert A.shape == (2, 513), name
+            assert np.allclose(A, expected), name
+            z = x + 1j*x[::-1]
+            assert np.allclose(backend.fft(z, 1024),
+                               np.fft.fft(z, 1024, axis=-1)), name
+    results = benchmark([(2, 1000), (2, 4096)])
+    assert sorted([name for t, name in results]) == sorted(available())
+    assert results[0][0] <= results[-1][0]
+    try:
+        get('nonexistent')
+    except ValueError:
+        pass
+    else:
+        assert False
+
+def test_unpack():
+    for n in (8, 9):
+        x = np.random.randn(3, n)
+        A = np.fft.rfft(x, axis=-1)
+        # scipy.fftpack.rfft layout: y0, Re y1, Im y1, Re y2, ...
+        y = np.empty((3, n))
+        y[:, 0] = A[:, 0].real
+        y[:, 1::2] = A[:, 1:1 + len(range(1, n, 2))].real
+        y[:, 2::2] = A[:, 1:1 + len(range(2, n, 2))].imag
+        assert np.allclose(unpack(y, n), A)
+
+if __name__ == '__main__':
+    test_backends()
+    test_unpack()
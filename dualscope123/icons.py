@@ -359,3 +359,41 @@ save = [\
 ".@@@@++++++++++++++++++++++#@@@#",
 ".@@@@++++++++++++++++++++++#@@@#",
 " ##############################+"]
+
+record=[
+"32 32 3 1",
+". c None",
+"a c #800000",
+"# c #e00000",
+"................................",
+"................................",
+"................................",
+"................................",
+"................................",
+"................................",
+"............aaaaaaaa............",
+"..........aaa######aaa..........",
+".........aa##########aa.........",
+"........aa############aa........",
+".......aa##############aa.......",
+".......a################a.......",
+"......aa################aa......",
+"......a##################a......",
+"......a##################a......",
+"......a##################a......",
+"......a##################a......",
+"......a##################a......",
+"......a##################a......",
+"......aa################aa......",
+".......a################a.......",
+".......aa##############aa.......",
+"........aa############aa........",
+".........aa##########aa.........",
+"..........aaa######aaa..........",
+"............aaaaaaaa............",
+"................................",
+"................................",
+"................................",
+"................................",
+"................................",
+"................................"]
@@ -38,6 +38,7 @@ PyQt4, PyQwt5 -- gui, graphics
 
 Optional packages:
 pyspectrum    -- expert mode spectrum calculation
+scipy, pyFFTW -- faster, multithreaded FFTs
 
 Typically, a modification of the Python path and ld library is necessary,
 like this:
@@ -56,17 +57,18 @@ Printing and exporting CSV and PDF files are provided.
 
 FFT options
 
-- by default we use the periogram algorithm from pyspectrum [1] - not 
+- the FFTs are computed by one of the backends of fftbackends.py: numpy,
+  scipy or pyFFTW, when installed. The backend is set in ~/.dualscope123:
+   [fft]
+   backend = auto   ; numpy, scipy, fftw or pyspectrum
+   threads = 4      ; scipy and fftw only, defaults to the number of CPUs
+  'auto', the default, times the installed backends at start-up and picks
+  the fastest one.
+
+- 'pyspectrum' uses the periogram algorithm from pyspectrum [1] - not 
   in Debian stable but available through pypi and easy_install.
   [1] https://www.assembla.com/spaces/PySpectrum/wiki
 
-- If 'pyspectrum' is not available, we fallback to using the FFT
- method from numpy to compute the PSD. 
-
-- Using numpy to calculate the FFT can be forced setting: 
-   USE_NUMPY_FFT = True
-  in the following code.
-
 - additionally, it is possible to use matplotlib.psd().
   -> you need to modify the sources to do so.
 
@@ -89,44 +91,133 @@ from PyQt4 import Qt
 from PyQt4 import Qwt5 as Qwt
 
 import numpy as np
-import numpy.fft as FFT
 
 # part of this package -- csv interface and toolbar icons
-from . import csvlib, icons, utils
+from . import csvlib, icons, utils, acquisition, recorder, trigger, averaging
+from . import envelope, psd, fftbackends
 import dualscope123.probes
 
-from dualscope123.probes import eth_nios
-
 # scope configuration
-CHANNELS = 2
+CHANNELS = 2      # set from the probe at start-up
 DEFAULT_TIMEBASE = 0.01
-BOTH12 = 0
-CH1 = 1
-CH2 = 2
+# longest timebase of the Time knob, s/div, lowered at start-up if the
+# acquisition depth cannot hold the frames. Frames are 10 divisions, twice
+# as many samples are read with autocorrelation
+MAX_TIMEBASE = 1.0
 scopeheight = 500 #px
 scopewidth = 800 #px
-SELECTEDCH = BOTH12
+SELECTEDCH = None # indices of the displayed channels, None for all of them
 TIMEPENWIDTH = 1
 FFTPENWIDTH = 2
+# trigger settings, from the [trigger] section of the config file
+TRIGGER_HYSTERESIS = 0.02 # fraction of the trigger channel full scale
+TRIGGER_HOLDOFF = 0.0     # s
+TRIGGER_PRETRIGGER = 0.0  # fraction of the frame shown before the trigger
+SEGMENTS = 100            # frames captured in a burst, [segments] count
+# averaging, from the [averaging] section of the config file
+AVERAGING_MODE = averaging.CUMULATIVE
+AVERAGING_FRAMES = averaging.DEFAULT_FRAMES
+# maximum redraws per second, [display] fps
+DISPLAY_FPS = 25
+# FFT window, [fft] window
+FFT_WINDOW = psd.DEFAULT_WINDOW
+# Welch estimator, [fft] segment (samples), overlap (fraction) and segments
+WELCH_SEGMENT = psd.DEFAULT_SEGMENT
+WELCH_OVERLAP = psd.DEFAULT_OVERLAP
+WELCH_SEGMENTS = psd.DEFAULT_SEGMENTS
+# zoom FFT bins, [fft] zoom
+ZOOM_POINTS = psd.DEFAULT_ZOOM_POINTS
+# FFT backend, [fft] backend and threads. 'auto' is replaced by the fastest
+# backend at start-up, see main()
+FFT_BACKEND = 'auto'
+FFT_THREADS = None        # the number of CPUs
+SPECTRUM_MODULE = False   # [fft] backend = pyspectrum
+spectrum = None           # the pyspectrum module, then
+# trace colors: (line, symbols), CH1 first
+TRACECOLORS = [(Qt.Qt.blue, Qt.Qt.darkBlue),
+               (Qt.Qt.magenta, Qt.Qt.darkMagenta),
+               (Qt.Qt.darkGreen, Qt.Qt.green),
+               (Qt.Qt.red, Qt.Qt.darkRed),
+               (Qt.Qt.darkCyan, Qt.Qt.cyan),
+               (Qt.Qt.darkYellow, Qt.Qt.yellow),
+               (Qt.Qt.black, Qt.Qt.darkGray),
+               (Qt.Qt.gray, Qt.Qt.darkGray)]
+
+def selected_channels():
+    """Indices of the channels to be processed and displayed."""
+    if SELECTEDCH is None:
+        return range(CHANNELS)
+    return list(SELECTEDCH)
+
+class Renderer(Qt.QObject):
+    """
+    Redraw scheduler.
+
+    The plots process frames as fast as they are acquired and only flag
+    themselves dirty; the renderer redraws the dirty, visible plots at
+    most fps times per second, so that frames processed in between are
+    coalesced and the newest one is drawn.
+    """
+    def __init__(self, fps, *args):
+        apply(Qt.QObject.__init__, (self,) + args)
+        self.plots = []
+        self.redraws = 0
+        self.timer_id = self.startTimer(int(1000.0/fps))
+
+    def add(self, plot):
+        self.plots.append(plot)
+
+    def timerEvent(self, e):
+        for plot in self.plots:
+            if plot.dirty and plot.isVisible():
+                plot.dirty = False
+                plot.setDisplay()
+                self.redraws += 1
+
+def visible_points(plot, t, y):
+    """Restrict the (curves, n) data y, sampled at t, to the x range shown
+    by plot and decimate it to about two points per pixel column."""
+    scale = plot.axisScaleDiv(Qwt.QwtPlot.xBottom)
+    # one more point on each side, for the lines to reach the borders
+    i0 = max(np.searchsorted(t, scale.lowerBound()) - 1, 0)
+    i1 = np.searchsorted(t, scale.upperBound()) + 1
+    return utils.decimate(t[i0:i1], y[..., i0:i1],
+                          plot.canvas().width() or scopewidth)
+
+def fill_frame(frame, data, active):
+    """Copy data into the active rows of frame, a (CHANNELS, n) array
+    reused from one call to the next, zeroing the other rows.
+
+    frame is reallocated only if n changes. Returns frame.
+    """
+    if frame is None or frame.shape != (CHANNELS, data.shape[1]):
+        frame = np.zeros((CHANNELS, data.shape[1]))
+    elif len(active) < CHANNELS:
+        frame.fill(0.0)
+    frame[active] = data
+    return frame
 
 # status messages
 freezeInfo = 'Freeze: Press mouse button and drag'
 cursorInfo = 'Cursor Pos: Press mouse button in plot region'
 
-# FFT CONFIG
-USE_NUMPY_FFT = False
-try:
-	import spectrum
-	print "(II) spectrum MODULE FOUND"
-	SPECTRUM_MODULE = True
-except ImportError:
-	print "(WW) PSD: spectrum MODULE NOT FOUND"
-	SPECTRUM_MODULE = False
-if USE_NUMPY_FFT:
-	print "(WW) SPECTRUM MODULE DISABLED in source"
-	SPECTRUM_MODULE = False
-if not SPECTRUM_MODULE:
-	print "(WW) PSD: using FFTs through NUMPY.fftpack"
+def choose_fft_backend(name, threads, sizes):
+    """Return the name of the FFT backend to use for frames of the given
+    sizes: name if it is installed, else the fastest one."""
+    if name != 'auto' and name not in fftbackends.BACKENDS:
+        print "(WW) Unknown FFT backend %s, using the fastest." % (name,)
+        name = 'auto'
+    elif name != 'auto' and not fftbackends.BACKENDS[name].available:
+        print "(WW) FFT backend %s not installed, using the fastest." % (name,)
+        name = 'auto'
+    if name == 'auto':
+        shapes = [(CHANNELS, psd.fast_length(n)) for n in sizes]
+        results = fftbackends.benchmark(shapes, threads)
+        print "(II) FFT backends: " + ", ".join(["%s %.2f ms" % (b, 1e3*t)
+                                                for t, b in results])
+        name = results[0][1]
+    print "(II) PSD: using FFTs through %s" % (name,)
+    return name
 
 # utility classes
 class LogKnob(Qwt.QwtKnob):
@@ -203,24 +294,30 @@ class Scope(Qwt.QwtPlot):
         self.setAxisMaxMajor(Qwt.QwtPlot.yRight, 10)
         self.setAxisMaxMinor(Qwt.QwtPlot.yRight, 0)
 
-        # curves for scope traces: 2 first so 1 is on top      
-        self.curve2 = Qwt.QwtPlotCurve('Trace2')
-        self.curve2.setSymbol(Qwt.QwtSymbol(Qwt.QwtSymbol.Ellipse,
-                              Qt.QBrush(2),
-                              Qt.QPen(Qt.Qt.darkMagenta),
-                              Qt.QSize(3, 3)))
-        self.curve2.setPen(Qt.QPen(Qt.Qt.magenta, TIMEPENWIDTH))
-        self.curve2.setYAxis(Qwt.QwtPlot.yRight)
-        self.curve2.attach(self)
-
-        self.curve1 = Qwt.QwtPlotCurve('Trace1')
-        self.curve1.setSymbol(Qwt.QwtSymbol(Qwt.QwtSymbol.Ellipse,
-                              Qt.QBrush(2),
-                              Qt.QPen(Qt.Qt.darkBlue),
-                              Qt.QSize(3, 3)))
-        self.curve1.setPen(Qt.QPen(Qt.Qt.blue, TIMEPENWIDTH))
-        self.curve1.setYAxis(Qwt.QwtPlot.yLeft)
-        self.curve1.attach(self)
+        # curves for scope traces: CH1 on the left axis, the others on the
+        # right one. The last one first, so that CH1 is on top
+        self.curves = []
+        for c in range(CHANNELS):
+            line, symbol = TRACECOLORS[c % len(TRACECOLORS)]
+            curve = Qwt.QwtPlotCurve('Trace%d' % (c + 1))
+            curve.setSymbol(Qwt.QwtSymbol(Qwt.QwtSymbol.Ellipse,
+                            Qt.QBrush(2),
+                            Qt.QPen(symbol),
+                            Qt.QSize(3, 3)))
+            curve.setPen(Qt.QPen(line, TIMEPENWIDTH))
+            curve.setYAxis(Qwt.QwtPlot.yLeft if c == 0 else Qwt.QwtPlot.yRight)
+            self.curves.append(curve)
+        for curve in reversed(self.curves):
+            curve.attach(self)
+        # overlaid segments of a burst capture
+        self.overlay = []
+        # to be redrawn by the Renderer
+        self.dirty = False
+        # peak detect mode: min/max envelope, optionally held across frames
+        self.peak = False
+        self.hold = False
+        self.holdmin = self.holdmax = None
+        self.envelope = None     # (times, values) of the envelope drawn
 
         # default settings
         self.triggerval = 0.10
@@ -231,8 +328,8 @@ class Scope(Qwt.QwtPlot):
         self.freeze = 0
         self.average = 0
         self.autocorrelation = 0
-        self.avcount = 0
-        self.datastream = None
+        self.averager = averaging.Averager(AVERAGING_MODE, AVERAGING_FRAMES)
+        self.frame = None
         self.offset1 = 0.0
         self.offset2 = 0.0
 	self.maxtime = 0.1
@@ -241,31 +338,36 @@ class Scope(Qwt.QwtPlot):
         # NumPy: f, g, a and p are arrays!
         self.dt = 1.0/samplerate
         self.f = np.arange(0.0, 10.0, self.dt)
-        self.a1 = 0.0*self.f
-        self.a2 = 0.0*self.f
-        self.curve1.setData(self.f, self.a1)
-        self.curve2.setData(self.f, self.a2)
+        # one row per channel
+        self.a = np.zeros((CHANNELS, len(self.f)))
+        for c, curve in enumerate(self.curves):
+            curve.setData(self.f, self.a[c])
 
-        # start self.timerEvent() callbacks running
-        self.timer_id = self.startTimer(self.maxtime*100+50)
         # plot
         self.replot()
 
     # convenience methods for knob callbacks
     def setMaxAmp(self, val):
         self.maxamp = val
+        self.dirty = True
 
     def setMaxAmp2(self, val):
         self.maxamp2 = val
+        self.dirty = True
 
     def setMaxTime(self, val):
         self.maxtime = val
 
     def setOffset1(self, val):
         self.offset1 = val
+        self.dirty = True
 
     def setOffset2(self, val):
         self.offset2 = val
+        self.dirty = True
+
+    def setDirty(self):
+        self.dirty = True
 
     def setTriggerLevel(self, val):
         self.triggerval = val
@@ -276,157 +378,136 @@ class Scope(Qwt.QwtPlot):
     def setTriggerSlope(self, val):
         self.triggerslope = val
 
+    def channelScales(self):
+        """Full scale and offset of every channel, as (channels, 1) arrays.
+
+        CH1 follows the Signal1 and offset1 knobs, the other channels the
+        Signal2 and offset2 knobs.
+        """
+        amps = np.empty((CHANNELS, 1))
+        offsets = np.empty((CHANNELS, 1))
+        amps[0], offsets[0] = self.maxamp, self.offset1
+        amps[1:], offsets[1:] = self.maxamp2, self.offset2
+        return amps, offsets
+
     # plot scope traces
     def setDisplay(self):
-        l = len(self.a1)
-        if SELECTEDCH == BOTH12:
-            self.curve1.setData(self.f[0:l], self.a1[:l]+self.offset1*self.maxamp)
-            self.curve2.setData(self.f[0:l], self.a2[:l]+self.offset2*self.maxamp2)
-        elif SELECTEDCH == CH2:
-            self.curve1.setData([0.0,0.0], [0.0,0.0])
-            self.curve2.setData(self.f[0:l], self.a2[:l]+self.offset2*self.maxamp2)
-        elif SELECTEDCH == CH1:
-            self.curve1.setData(self.f[0:l], self.a1[:l]+self.offset1*self.maxamp)
-            self.curve2.setData([0.0,0.0], [0.0,0.0])
+        if self.overlay:
+            # segments overlaid, see showSegments()
+            self.replot()
+            return
+        if self.peak and self.envelope is not None:
+            t, y = self.envelope
+        else:
+            l = self.a.shape[1]
+            t, y = visible_points(self, self.f[0:l], self.a)
+        amps, offsets = self.channelScales()
+        active = selected_channels()
+        for c, curve in enumerate(self.curves):
+            if c in active:
+                curve.setData(t, y[c]+offsets[c]*amps[c])
+            else:
+                curve.setData([0.0,0.0], [0.0,0.0])
+        self.replot()
+
+    def showSegments(self, segments, index=None):
+        """Display a segment of a trigger.Segments burst capture, or all
+        of them overlaid if index is None."""
+        self.clearOverlay()
+        if index is not None:
+            self.a = np.array(segments.data[index], dtype=np.float_)
+            self.setDisplay()
+            return
+        l = segments.length
+        amps, offsets = self.channelScales()
+        for k in range(segments.filled):
+            t, y = visible_points(self, self.f[0:l], segments.data[k])
+            for c in selected_channels():
+                curve = Qwt.QwtPlotCurve('Segment%d_%d' % (k + 1, c + 1))
+                curve.setPen(Qt.QPen(TRACECOLORS[c % len(TRACECOLORS)][0],
+                                     TIMEPENWIDTH))
+                curve.setYAxis(Qwt.QwtPlot.yLeft if c == 0 else Qwt.QwtPlot.yRight)
+                curve.setData(t, y[c]+offsets[c]*amps[c])
+                curve.attach(self)
+                self.overlay.append(curve)
+        for curve in self.curves:
+            curve.setData([0.0,0.0], [0.0,0.0])
         self.replot()
 
+    def setPeak(self, on):
+        self.peak = on
+        self.holdmin = self.holdmax = None
+        self.envelope = None
+
+    def setHold(self, on):
+        self.hold = on
+        self.holdmin = self.holdmax = None
+
+    def showEnvelope(self, mins, maxs, size):
+        """Show the (channels, buckets) min/max envelope, buckets of size
+        samples, merging it into the held envelope in max-hold mode."""
+        if self.hold:
+            if self.holdmin is None or self.holdmin.shape != mins.shape:
+                self.holdmin, self.holdmax = mins.copy(), maxs.copy()
+            else:
+                np.minimum(self.holdmin, mins, self.holdmin)
+                np.maximum(self.holdmax, maxs, self.holdmax)
+            mins, maxs = self.holdmin, self.holdmax
+        nb = mins.shape[1]
+        # a vertical segment from min to max per bucket
+        t = np.repeat(np.arange(nb)*size*self.dt, 2)
+        y = np.empty((mins.shape[0], 2*nb))
+        y[:, 0::2] = mins
+        y[:, 1::2] = maxs
+        self.envelope = (t, y)
+        self.dirty = True
+
+    def clearOverlay(self):
+        for curve in self.overlay:
+            curve.detach()
+        self.overlay = []
+
     def getValue(self, index):
-        return self.f[index], self.a[index]
+        return self.f[index], self.a[:, index]
             
     def setAverage(self, state):
         self.average = state
-        self.avcount = 0
+        self.averager.reset()
 
     def setAutoc(self, state):
         self.autocorrelation = state
-        self.avcount = 0
+        self.averager.reset()
 
     def setFreeze(self, freeze):
         self.freeze = freeze
 
-    def setDatastream(self, datastream):
-        self.datastream = datastream
-
-    def updateTimer(self):
-        self.killTimer(self.timer_id)
-        self.timer_id = self.startTimer(self.maxtime*100 + 50)
-
-    # timer callback that does the work
-    def timerEvent(self,e):   # Scope
-	global fftbuffersize
-        if self.datastream == None: return
+    def framePoints(self):
+        """Number of samples per channel needed by the next frame."""
+        points = int(np.ceil(self.maxtime*samplerate))
+        if self.autocorrelation and not self.peak:
+            # twice as much data, to compute the autocorrelation for all the
+            # time points displayed
+            return 2*points
+        return points
+
+    # processes the frame acquired by FScopeDemo.timerEvent()
+    def process(self, X):   # Scope
         if self.freeze == 1: return
-	points = int(np.ceil(self.maxtime*samplerate))
-	if self.triggerCH or self.autocorrelation:
-		# we read twice as much data to be sure to be able to display data for all time points.
-		# independently of trigger point location.
-		read_points = 2*points
-	else:
-		read_points = points
-	fftbuffersize = read_points
-	if SELECTEDCH == BOTH12:
-		channel = 12
-		if verbose:
-			print "Reading %d frames" % (read_points)
-        	X, Y = self.datastream.read(channel, read_points, verbose)
-		if X is None or not len(X): return
-		if len(X) == 0: return
-		i=0
-		data_CH1 = X
-		data_CH2 = Y
-	elif SELECTEDCH == CH1:
-		channel = 1
-		if verbose:
-			print "Reading %d frames" % (read_points)
-        	X = self.datastream.read(channel, read_points, verbose)
-		if X is None or not len(X): return
-		if len(X) == 0: return
-		i=0
-		data_CH1 = X
-		data_CH2 = np.zeros((points,))
-	if SELECTEDCH == CH2:
-		channel = 2
-		if verbose:
-			print "Reading %d frames" % (read_points)
-        	X = self.datastream.read(channel, read_points, verbose)
-		if X is None or not len(X): return
-		data_CH2 = X
-		data_CH1 = np.zeros((points,))
-
-	if self.triggerCH == 1 and (SELECTEDCH == BOTH12 or SELECTEDCH == CH1):
-		print "Waiting for CH1 trigger..."
-		if self.triggerslope == 0:
-			zero_crossings = np.where(np.diff(np.sign(data_CH1[points/2:-points/2] - self.triggerval*self.maxamp)) != 0)[0]
-		if self.triggerslope == 1:
-			zero_crossings = np.where(np.diff(np.sign(data_CH1[points/2:-points/2] - self.triggerval*self.maxamp)) > 0)[0]
-		if self.triggerslope == 2:
-			zero_crossings = np.where(np.diff(np.sign(data_CH1[points/2:-points/2] - self.triggerval*self.maxamp)) < 0)[0]
-		if not len(zero_crossings): return
-		print "Triggering on sample", zero_crossings[0]
-		imin = zero_crossings[0]
-		imax = zero_crossings[0] + points
-		data_CH1 = data_CH1[imin:imax]
-	elif self.triggerCH == 2 and (SELECTEDCH == BOTH12 or SELECTEDCH == CH2):
-		print "Waiting for CH2 trigger..."
-		if self.triggerslope == 0:
-			zero_crossings = np.where(np.diff(np.sign(data_CH2[points/2:-points/2] - self.triggerval*self.maxamp2)) != 0)[0]
-		if self.triggerslope == 1:
-			zero_crossings = np.where(np.diff(np.sign(data_CH2[points/2:-points/2] - self.triggerval*self.maxamp2)) > 0)[0]
-		if self.triggerslope == 2:
-			zero_crossings = np.where(np.diff(np.sign(data_CH2[points/2:-points/2] - self.triggerval*self.maxamp2)) < 0)[0]
-		if not len(zero_crossings): return
-		print "Triggering on sample", zero_crossings[0]
-		imin = zero_crossings[0]
-		imax = zero_crossings[0] + points
-		data_CH2 = data_CH2[imin:imax]
+        points = int(np.ceil(self.maxtime*samplerate))
+        # all the processing runs on a (channels, samples) array, holding
+        # the selected channels only
+        active = selected_channels()
+        data = X[active]
 
         if self.autocorrelation:
-            if SELECTEDCH == BOTH12 or SELECTEDCH == CH1:
-                data_CH1 = utils.autocorrelation(data_CH1[:2*points])[:points]
-            else:
-		data_CH1 = np.zeros((points,))
-            if SELECTEDCH == BOTH12 or SELECTEDCH == CH2:
-                data_CH2 = utils.autocorrelation(data_CH2[:2*points])[:points]
-            else:
-		data_CH2 = np.zeros((points,))
-		
+            data = utils.autocorrelation(data[:, :2*points])[:, :points]
+
+        self.frame = fill_frame(self.frame, data, active)
         if self.average == 0:
-            self.a1 = data_CH1
-            self.a2 = data_CH2
+            self.a = self.frame
         else:
-            self.avcount += 1
-            if self.avcount == 1:
-                self.sumCH1 = np.array(data_CH1, dtype=np.float_)
-                self.sumCH2 = np.array(data_CH2, dtype=np.float_)
-            else:
-                if SELECTEDCH==BOTH12:
-                    assert len(data_CH1) == len(data_CH2)
-                    lp = len(data_CH1)
-                    if len(self.sumCH1) == lp and len(self.sumCH2) == lp:
-                        self.sumCH1 = self.sumCH1[:lp] + np.array(data_CH1[:lp], dtype=np.float_)
-                        self.sumCH2 = self.sumCH2[:lp] + np.array(data_CH2[:lp], dtype=np.float_)
-                    else:
-                        self.sumCH1 = np.array(data_CH1, dtype=np.float_)
-                        self.sumCH2 = np.array(data_CH2, dtype=np.float_)
-                        self.avcount = 1
-                elif SELECTEDCH == CH1:
-                    lp = len(data_CH1)
-                    if len(self.sumCH1) == lp:
-                        self.sumCH1 = self.sumCH1[:lp] + np.array(data_CH1[:lp], dtype=np.float_)
-                    else:
-                        self.sumCH1 = np.array(data_CH1, dtype=np.float_)
-                        self.avcount = 1
-                elif SELECTEDCH==CH2: 
-                    lp = len(data_CH2)
-                    if len(self.sumCH2) == lp:
-                        self.sumCH2 = self.sumCH2[:lp] + np.array(data_CH2[:lp], dtype=np.float_)
-                    else:
-                        self.sumCH2 = np.array(data_CH2, dtype=np.float_)
-                        self.avcount = 1
-        
-            self.a1 = self.sumCH1/self.avcount
-            self.a2 = self.sumCH2/self.avcount
-        self.setDisplay()
+            self.a = self.averager.add(self.frame)
+        self.dirty = True
 
 
 inittime=0.01
@@ -448,8 +529,8 @@ class ScopeFrame(Qt.QFrame):
 	self.triggerComboBox = Qt.QComboBox(self)
 	self.triggerComboBox.setGeometry(hknobpos+10, 50, 100, 40)#"Channel: ")
 	self.triggerComboBox.addItem("Trigger off")
-	self.triggerComboBox.addItem("CH1")
-	self.triggerComboBox.addItem("CH2")
+        for c in range(CHANNELS):
+            self.triggerComboBox.addItem("CH%d" % (c + 1))
         self.triggerComboBox.setCurrentIndex(0)
 	self.triggerSlopeComboBox = Qt.QComboBox(self)
 	self.triggerSlopeComboBox.setGeometry(hknobpos+10, 100, 100, 40)#"Channel: ")
@@ -464,7 +545,7 @@ class ScopeFrame(Qt.QFrame):
         self.knbOffset1=LblKnob(self, 10, vknobpos, "offset1")
         self.knbOffset2=LblKnob(self, 310, vknobpos, "offset2")
 
-        self.knbTime.setRange(0.0001, 1.0)
+        self.knbTime.setRange(0.0001, MAX_TIMEBASE)
         self.knbTime.setValue(DEFAULT_TIMEBASE)
 
         self.knbSignal.setRange(1, 1e6, 1)
@@ -532,32 +613,31 @@ class ScopeFrame(Qt.QFrame):
         return dt
 
     def setTimebase(self, val):
-        dt = self._calcKnobVal(val)
+        # the knob values are rounded to 1-2-5 steps, possibly up
+        dt = min(self._calcKnobVal(val), MAX_TIMEBASE)
         self.plot.setAxisScale( Qwt.QwtPlot.xBottom, 0.0, 10.0*dt)
 	self.plot.setMaxTime(dt*10.0)
-        self.plot.replot()
+        self.plot.setDirty()
 
     def setAmplitude(self, val):
         dt = self._calcKnobVal(val)
         self.plot.setAxisScale( Qwt.QwtPlot.yLeft, -dt, dt)
         self.plot.setMaxAmp(dt)
-        self.plot.replot()
 
     def setAmplitude2(self, val):
         dt = self._calcKnobVal(val)
         self.plot.setAxisScale( Qwt.QwtPlot.yRight, -dt, dt)
         self.plot.setMaxAmp2(dt)
-        self.plot.replot()
 
     def setTriggerlevel(self, val):
         self.plot.setTriggerLevel(val)
-        self.plot.setDisplay()
+        self.plot.setDirty()
 
     def setTriggerCH(self, val):
 	if val == 0:
 		val = None
 	self.plot.setTriggerCH(val)
-	self.plot.setDisplay()
+	self.plot.setDirty()
 
 #--------------------------------------------------------------------
 
@@ -585,46 +665,54 @@ class FScope(Qwt.QwtPlot):
         self.setAxisMaxMajor(Qwt.QwtPlot.yLeft, 10);
         self.setAxisMaxMinor(Qwt.QwtPlot.yLeft, 0);
 
-        # curves
-        self.curve2 = Qwt.QwtPlotCurve('PSTrace2')
-        self.curve2.setPen(Qt.QPen(Qt.Qt.magenta,FFTPENWIDTH))
-        self.curve2.setYAxis(Qwt.QwtPlot.yLeft)
-        self.curve2.attach(self)
-        
-        self.curve1 = Qwt.QwtPlotCurve('PSTrace1')
-        self.curve1.setPen(Qt.QPen(Qt.Qt.blue,FFTPENWIDTH))
-        self.curve1.setYAxis(Qwt.QwtPlot.yLeft)
-        self.curve1.attach(self)
+        # curves, the last one first so that CH1 is on top
+        self.curves = []
+        for c in range(CHANNELS):
+            curve = Qwt.QwtPlotCurve('PSTrace%d' % (c + 1))
+            curve.setPen(Qt.QPen(TRACECOLORS[c % len(TRACECOLORS)][0],
+                                 FFTPENWIDTH))
+            curve.setYAxis(Qwt.QwtPlot.yLeft)
+            self.curves.append(curve)
+        for curve in reversed(self.curves):
+            curve.attach(self)
         
         self.triggerval=0.0
         self.maxamp=100.0
         self.maxamp2=100.0
         self.freeze=0
         self.average=0
-        self.avcount=0
+        self.averager = averaging.Averager(AVERAGING_MODE, AVERAGING_FRAMES)
+        self.frame = None
+        self.dirty = False
+        # window, normalisation and frequency axis, cached. pyspectrum
+        # returns unpadded one-sided spectra
+        self.psd = psd.PSD(samplerate, FFT_WINDOW, pad=not SPECTRUM_MODULE,
+                           backend=fftbackends.get(FFT_BACKEND, FFT_THREADS))
+        # zoom FFT of the band shown, see setBand()
+        self.zoom = psd.Zoom(samplerate, FFT_WINDOW,
+                             fftbackends.get(FFT_BACKEND, FFT_THREADS))
+        self.band = (0.0, 12.5*initfreq)
         self.logy=1
-        self.datastream=None
+        # FFT length, follows the length of the frames
+        self.buffersize=CHUNK
         
         self.dt=1.0/samplerate
-        self.df=1.0/(fftbuffersize*self.dt)
+        self.df=1.0/(self.buffersize*self.dt)
         self.f = np.arange(0.0, samplerate, self.df)
-        self.a1 = 0.0*self.f
-        self.a2 = 0.0*self.f
-        self.curve1.setData(self.f, self.a1)
-        self.curve2.setData(self.f, self.a2)
+        self.a = np.zeros((CHANNELS, len(self.f)))
+        for c, curve in enumerate(self.curves):
+            curve.setData(self.f, self.a[c])
         self.setAxisScale( Qwt.QwtPlot.xBottom, 0.0, 12.5*initfreq)
         self.setAxisScale( Qwt.QwtPlot.yLeft, -120.0, 0.0)
 
-        self.startTimer(100)
         self.replot()
 
     def resetBuffer(self):
-        self.df=1.0/(fftbuffersize*self.dt)
+        self.df=1.0/(self.buffersize*self.dt)
         self.f = np.arange(0.0, samplerate, self.df)
-        self.a1 = 0.0*self.f
-        self.a2 = 0.0*self.f
-        self.curve1.setData(self.curve1, self.f, self.a1)
-        self.curve1.setData(self.curve1, self.f, self.a2)
+        self.a = np.zeros((CHANNELS, len(self.f)))
+        for c, curve in enumerate(self.curves):
+            curve.setData(self.f, self.a[c])
         
     def setMaxAmp(self, val):
         if val>0.6:
@@ -641,107 +729,102 @@ class FScope(Qwt.QwtPlot):
 
     def setTriggerLevel(self, val):
         self.triggerval=val
+
+    def setDirty(self):
+        self.dirty = True
         
     def setDisplay(self):
-        n=fftbuffersize/2
-        if SELECTEDCH==BOTH12:
-            self.curve1.setData(self.f[0:n], self.a1[:n])
-            self.curve2.setData(self.f[0:n], self.a2[:n])
-        elif SELECTEDCH==CH2:
-            self.curve1.setData([0.0,0.0], [0.0,0.0])
-            self.curve2.setData(self.f[0:n], self.a2[:n])
-        elif SELECTEDCH==CH1:
-            self.curve1.setData(self.f[0:n], self.a1[:n])
-            self.curve2.setData([0.0,0.0], [0.0,0.0])
+        # one-sided spectra, 0 to samplerate/2
+        n=min(len(self.f), self.a.shape[1])
+        f, y = visible_points(self, self.f[0:n], self.a[:, :n])
+        active = selected_channels()
+        for c, curve in enumerate(self.curves):
+            if c in active:
+                curve.setData(f, y[c])
+            else:
+                curve.setData([0.0,0.0], [0.0,0.0])
         self.replot()
         
     def getValue(self, index):
-        return self.f[index],self.a1[index]
+        return self.f[index],self.a[:, index]
             
     def setAverage(self, state):
         self.average = state
-        self.avcount=0
+        self.averager.reset()
 
     def setFreeze(self, freeze):
         self.freeze = freeze
 
-    def setDatastream(self, datastream):
-        self.datastream = datastream
-
-    def timerEvent(self,e):     # FFT
-	global fftbuffersize
-        if self.datastream == None: return
+    # processes the frame acquired by FScopeDemo.timerEvent()
+    def process(self, X):     # FFT
         if self.freeze == 1: return
-	if SELECTEDCH == BOTH12:
-		channel = 12
-        	X, Y = self.datastream.read(channel, fftbuffersize, verbose)
-		if X is None or not len(X): return
-		data_CH1 = X[:fftbuffersize]
-		data_CH2 = Y[:fftbuffersize]
-	elif SELECTEDCH == CH1:
-		channel = 1
-        	X = self.datastream.read(channel, fftbuffersize, verbose)
-		if X is None or not len(X): return
-		data_CH1 = X[:fftbuffersize]
-		data_CH2 = np.ones((fftbuffersize,))
-	elif SELECTEDCH == CH2:
-		channel = 2
-        	X = self.datastream.read(channel, fftbuffersize, verbose)
-		if X is None or not len(X): return
-		data_CH2 = X[:fftbuffersize]
-		data_CH1 = np.ones((fftbuffersize,))
-        self.df = 1.0/(fftbuffersize*self.dt)
-        self.setAxisTitle(Qwt.QwtPlot.xBottom, 'Frequency [Hz] - Bin width %g Hz' % (self.df,))
-        self.f = np.arange(0.0, samplerate, self.df)
+        if X is None or not X.shape[1]: return
+        self.buffersize = X.shape[1]
+        # the selected channels, processed at once as a (channels, N) array
+        active = selected_channels()
+        data = X[active]
+        self.psd.setup(self.buffersize)
+        self.setAxis(self.psd)
         if not SPECTRUM_MODULE:
-        	lenX = fftbuffersize
-        	window = np.blackman(lenX)
-        	sumw = np.sum(window*window)
-        	A = FFT.fft(data_CH1*window) #lenX
-        	B = (A*np.conjugate(A)).real
-        	A = FFT.fft(data_CH2*window) #lenX
-        	B2 = (A*np.conjugate(A)).real
-        	sumw *= 2.0   # sym about Nyquist (*4); use rms (/2)
-        	sumw /= self.dt  # sample rate
-        	B /= sumw
-        	B2 /= sumw
+            B = self.psd(data)
         else:
-		print "FFT buffer size: %d points" % (fftbuffersize,)
-        	B = spectrum.Periodogram(np.array(data_CH1, dtype=float64), samplerate)
-		B.sides = 'onesided'
-		B.run()
-		B = B.get_converted_psd('onesided')
-        	B2 = spectrum.Periodogram(np.array(data_CH2, dtype=float64), samplerate)
-		B2.sides = 'onesided'
-		B2.run()
-		B2 = B2.get_converted_psd('onesided')
+            print "FFT buffer size: %d points" % (self.buffersize,)
+            B = []
+            for x in data:
+                P = spectrum.Periodogram(np.array(x, dtype=np.float64), samplerate)
+                P.sides = 'onesided'
+                P.run()
+                B.append(P.get_converted_psd('onesided'))
+            B = np.array(B)
+        self.addSpectrum(B, active)
+
+    # shows the PSD estimated by a psd.Welch sink, if it has a new one
+    def processWelch(self, welch):
+        if self.freeze == 1: return
+        B = welch.fetch()
+        if B is None: return
+        active = selected_channels()
+        self.setAxis(welch.psd)
+        self.addSpectrum(B[active], active)
+
+    def setBand(self, lo, hi):
+        """Set the band computed in zoom mode, in Hz."""
+        self.band = (lo, hi)
+
+    def zoomPoints(self, maxpoints):
+        """Number of samples per channel needed by the next zoomed frame,
+        at most maxpoints."""
+        lo, hi = self.band
+        return self.zoom.setup(ZOOM_POINTS, lo, hi, maxpoints)
+
+    # processes the frame read by FScopeDemo.zoomSpectrum()
+    def processZoom(self, X):
+        if self.freeze == 1: return
+        if X is None or X.shape[1] < self.zoom.length: return
+        active = selected_channels()
+        B = self.zoom(X[active])
+        self.setAxis(self.zoom)
+        self.addSpectrum(B, active)
+
+    def setAxis(self, psd):
+        if self.f is not psd.f:
+            # the frame length changed
+            self.df = psd.df
+            self.f = psd.f
+            self.setAxisTitle(Qwt.QwtPlot.xBottom, 'Frequency [Hz] - Bin width %g Hz' % (self.df,))
+
+    def addSpectrum(self, B, active):
         if self.logy:
-            P1 = np.log10(B)*10.0
-            P2 = np.log10(B2)*10.0
-            P1 -= P1.max()
-            P2 -= P2.max()
+            P = np.log10(B)*10.0
+            P -= P.max(axis=-1)[:, np.newaxis]
         else:
-            P1 = B
-            P2 = B2
+            P = B
+        self.frame = fill_frame(self.frame, P, active)
         if not self.average:
-            self.a1 = P1
-            self.a2 = P2
-            self.avcount = 0
+            self.a = self.frame
         else:
-            self.avcount += 1
-            if self.avcount == 1:
-                self.sumP1 = P1
-                self.sumP2 = P2
-            elif self.sumP1.shape != P1.shape or self.sumP1.shape != P1.shape:
-                self.avcount = 1
-                self.sumP1 = P1
-                self.sumP2 = P2
-            else:
-                self.sumP1 += P1
-                self.sumP2 += P2
-            self.a1 = self.sumP1/self.avcount
-            self.a2 = self.sumP2/self.avcount
-        self.setDisplay()
+            self.a = self.averager.add(self.frame)
+        self.dirty = True
 
 initfreq = 100.0
 class FScopeFrame(Qt.QFrame):
@@ -803,12 +886,13 @@ class FScopeFrame(Qt.QFrame):
     def setTimebase(self, val):
         dt = self._calcKnobVal(val)
         self.plot.setAxisScale(Qwt.QwtPlot.xBottom, 0.0, 12.5*dt)
-        self.plot.replot()
+        self.plot.setBand(0.0, 12.5*dt)
+        self.plot.setDirty()
 
     def setAmplitude(self, val):
         minp = self._calcKnobVal(val)
         self.plot.setAxisScale(Qwt.QwtPlot.yLeft, -int(np.log10(minp)*20), 0.0)
-        self.plot.replot()
+        self.plot.setDirty()
         
 #---------------------------------------------------------------------
 
@@ -857,6 +941,14 @@ class FScopeDemo(Qt.QMainWindow):
         self.btnSave.setToolButtonStyle(Qt.Qt.ToolButtonTextUnderIcon)
         toolBar.addWidget(self.btnSave)
 
+        self.btnRecord = Qt.QToolButton(toolBar)
+        self.btnRecord.setText("Record")
+        self.btnRecord.setIcon(Qt.QIcon(Qt.QPixmap(icons.record)))
+        self.btnRecord.setCheckable(True)
+        self.btnRecord.setToolButtonStyle(Qt.Qt.ToolButtonTextUnderIcon)
+        toolBar.addWidget(self.btnRecord)
+        self.recorder = None
+
         self.btnPDF = Qt.QToolButton(toolBar)
         self.btnPDF.setText("Export PDF")
         self.btnPDF.setIcon(Qt.QIcon(Qt.QPixmap(icons.pdf)))
@@ -882,6 +974,26 @@ class FScopeDemo(Qt.QMainWindow):
         self.btnAvge.setCheckable(True)
         self.btnAvge.setToolButtonStyle(Qt.Qt.ToolButtonTextUnderIcon)
         toolBar.addWidget(self.btnAvge)
+        self.lstAvge = Qt.QComboBox(toolBar)
+        for i, mode in enumerate(averaging.MODES):
+            self.lstAvge.insertItem(i, mode)
+        self.lstAvge.setCurrentIndex(averaging.MODES.index(AVERAGING_MODE))
+        toolBar.addWidget(self.lstAvge)
+
+        self.btnWelch = Qt.QToolButton(toolBar)
+        self.btnWelch.setText("welch")
+        self.btnWelch.setIcon(Qt.QIcon(Qt.QPixmap(icons.pwspec)))
+        self.btnWelch.setCheckable(True)
+        self.btnWelch.setToolButtonStyle(Qt.Qt.ToolButtonTextUnderIcon)
+        toolBar.addWidget(self.btnWelch)
+
+        self.btnZoom = Qt.QToolButton(toolBar)
+        self.btnZoom.setText("zoom")
+        self.btnZoom.setIcon(Qt.QIcon(Qt.QPixmap(icons.pwspec)))
+        self.btnZoom.setCheckable(True)
+        self.btnZoom.setToolButtonStyle(Qt.Qt.ToolButtonTextUnderIcon)
+        toolBar.addWidget(self.btnZoom)
+        self.zoomState = 0
 
         self.btnAutoc = Qt.QToolButton(toolBar)
         self.btnAutoc.setText("autocorrelation")
@@ -890,6 +1002,34 @@ class FScopeDemo(Qt.QMainWindow):
         self.btnAutoc.setToolButtonStyle(Qt.Qt.ToolButtonTextUnderIcon)
         toolBar.addWidget(self.btnAutoc)
 
+        self.btnPeak = Qt.QToolButton(toolBar)
+        self.btnPeak.setText("peak detect")
+        self.btnPeak.setIcon(Qt.QIcon(Qt.QPixmap(icons.scope)))
+        self.btnPeak.setCheckable(True)
+        self.btnPeak.setToolButtonStyle(Qt.Qt.ToolButtonTextUnderIcon)
+        toolBar.addWidget(self.btnPeak)
+
+        self.btnHold = Qt.QToolButton(toolBar)
+        self.btnHold.setText("max hold")
+        self.btnHold.setIcon(Qt.QIcon(Qt.QPixmap(icons.avge)))
+        self.btnHold.setCheckable(True)
+        self.btnHold.setToolButtonStyle(Qt.Qt.ToolButtonTextUnderIcon)
+        toolBar.addWidget(self.btnHold)
+
+        self.btnSegments = Qt.QToolButton(toolBar)
+        self.btnSegments.setText("segments")
+        self.btnSegments.setIcon(Qt.QIcon(Qt.QPixmap(icons.scope)))
+        self.btnSegments.setCheckable(True)
+        self.btnSegments.setToolButtonStyle(Qt.Qt.ToolButtonTextUnderIcon)
+        toolBar.addWidget(self.btnSegments)
+        self.lstSegment = Qt.QSpinBox(toolBar)
+        self.lstSegment.setPrefix("Segment ")
+        self.lstSegment.setSpecialValueText("All segments")
+        self.lstSegment.setRange(0, 0)
+        self.lstSegment.setEnabled(False)
+        toolBar.addWidget(self.lstSegment)
+        self.segs = None
+
         #self.lstLabl = Qt.QLabel("Buffer:",toolBar)
         #toolBar.addWidget(self.lstLabl)
         #self.lstChan = Qt.QComboBox(toolBar)
@@ -901,19 +1041,32 @@ class FScopeDemo(Qt.QMainWindow):
         self.lstLR = Qt.QLabel("Channels:",toolBar)
         toolBar.addWidget(self.lstLR)
         self.lstLRmode = Qt.QComboBox(toolBar)
-        self.lstLRmode.insertItem(0,"1&2")
-        self.lstLRmode.insertItem(1,"CH1")
-        self.lstLRmode.insertItem(2,"CH2")
+        self.lstLRmode.insertItem(0,"1&2" if CHANNELS == 2 else "All")
+        for c in range(CHANNELS):
+            self.lstLRmode.insertItem(c + 1,"CH%d" % (c + 1))
         toolBar.addWidget(self.lstLRmode)
 
         self.connect(self.btnPrint, Qt.SIGNAL('clicked()'), self.printPlot)
         self.connect(self.btnSave, Qt.SIGNAL('clicked()'), self.saveData)
+        self.connect(self.btnRecord, Qt.SIGNAL('toggled(bool)'), self.record)
         self.connect(self.btnPDF, Qt.SIGNAL('clicked()'), self.printPDF)
         self.connect(self.btnFreeze, Qt.SIGNAL('toggled(bool)'), self.freeze)
         self.connect(self.btnMode, Qt.SIGNAL('toggled(bool)'), self.mode)
         self.connect(self.btnAvge, Qt.SIGNAL('toggled(bool)'), self.average)
+        self.connect(self.lstAvge, Qt.SIGNAL('activated(int)'),
+                        self.averageMode)
+        self.connect(self.btnWelch, Qt.SIGNAL('toggled(bool)'),
+                        self.welchMode)
+        self.connect(self.btnZoom, Qt.SIGNAL('toggled(bool)'), self.zoomMode)
         self.connect(self.btnAutoc, Qt.SIGNAL('toggled(bool)'),
                         self.autocorrelation)
+        self.connect(self.btnPeak, Qt.SIGNAL('toggled(bool)'), self.peakDetect)
+        self.connect(self.btnHold, Qt.SIGNAL('toggled(bool)'),
+                        self.scope.plot.setHold)
+        self.connect(self.btnSegments, Qt.SIGNAL('toggled(bool)'),
+                        self.segments)
+        self.connect(self.lstSegment, Qt.SIGNAL('valueChanged(int)'),
+                        self.showSegment)
         #self.connect(self.lstChan, Qt.SIGNAL('activated(int)'), self.fftsize)
         self.connect(self.lstLRmode, Qt.SIGNAL('activated(int)'), self.channel)
         self.connect(self.scope.picker,
@@ -932,12 +1085,148 @@ class FScopeDemo(Qt.QMainWindow):
                         Qt.SIGNAL('currentChanged(int)'),
                         self.mode)
         self.showInfo(cursorInfo)
+
+        # one acquisition per tick, processed by both the scope and the
+        # power spectrum, whichever tab is shown
+        self.datastream = None
+        self.trigger = None
+        self.peak = None
+        self.welch = None
+        self._processed = None   # stream position of the last frame processed
+        self._zoomed = None      # the same, in zoom mode
+        self._averaged = None    # the same, last frame averaged
+        # frames are processed at the acquisition block rate, and drawn by
+        # the renderer at the display rate
+        self.timer_id = self.startTimer(
+                min(max(int(1000.0*CHUNK/samplerate), 10), 100))
+        self.renderer = Renderer(DISPLAY_FPS, self)
+        self.renderer.add(self.scope.plot)
+        self.renderer.add(self.pwspec.plot)
         #self.showFullScreen()
         #print self.size()
 
     def showInfo(self, text):
         self.statusBar().showMessage(text)
 
+    def setDatastream(self, datastream):
+        self.datastream = datastream
+        # the trigger scans every acquired block
+        self.trigger = trigger.Trigger(datastream)
+        datastream.add_sink(self.trigger)
+        # so does the peak detector, in peak detect mode
+        self.peak = envelope.PeakDetector(datastream.CHANNELS, datastream.DTYPE)
+        datastream.add_sink(self.peak)
+        # and the Welch estimator, when enabled
+        self.welch = psd.Welch(datastream, datastream.RATE, WELCH_SEGMENT,
+                               WELCH_OVERLAP, FFT_WINDOW, WELCH_SEGMENTS,
+                               fftbackends.get(FFT_BACKEND, FFT_THREADS,
+                                               realtime=True))
+        datastream.add_sink(self.welch)
+
+    def timerEvent(self, e):
+        if self.datastream is None or self.freezeState: return
+        if self.segs is not None:
+            self.segmentsProgress()
+            return
+        if self.welch.enabled:
+            # estimated from the stream, whether or not a frame is shown
+            self.pwspec.plot.processWelch(self.welch)
+        elif self.zoomState:
+            self.zoomSpectrum()
+        read_points = self.scope.plot.framePoints()
+        if verbose:
+            print "Reading %d frames" % (read_points)
+        if self.scope.plot.triggerCH:
+            X = self.triggeredFrame(read_points)
+        else:
+            self.trigger.disable()
+            written = self.datastream.written
+            if written == self._processed:
+                # nothing new
+                return
+            # averaged frames must not overlap, or the same samples would
+            # be counted many times: wait for read_points new ones
+            fresh = not self.averageState or self._averaged is None or \
+                    written - self._averaged >= read_points
+            if not fresh and not self.scope.plot.peak:
+                return
+            self._processed = written
+            X = self.datastream.latest(read_points)
+        if self.scope.plot.peak:
+            self.showEnvelope(X)
+        if X is None or not X.shape[1]: return
+        if not self.scope.plot.triggerCH:
+            if not fresh:
+                # the envelope only
+                return
+            if self.averageState:
+                self._averaged = written
+        if not self.scope.plot.peak:
+            self.scope.plot.process(X)
+        if not self.welch.enabled and not self.zoomState:
+            self.pwspec.plot.process(X)
+
+    def zoomSpectrum(self):
+        # the band only, from the newest samples; the ring buffer may be
+        # overwritten by a block while it is read
+        plot = self.pwspec.plot
+        npoints = plot.zoomPoints(self.datastream.capacity)
+        if self.datastream.written == self._zoomed:
+            return
+        self._zoomed = self.datastream.written
+        plot.processZoom(self.datastream.latest(npoints))
+
+    def welchMode(self, on):
+        if on:
+            self.btnZoom.setChecked(False)
+            self.welch.configure()
+        else:
+            self.welch.disable()
+        self.pwspec.plot.averager.reset()
+
+    def zoomMode(self, on):
+        if on:
+            self.btnWelch.setChecked(False)
+        self.zoomState = 1 if on else 0
+        self.pwspec.plot.averager.reset()
+
+    def peakDetect(self, on):
+        self.scope.plot.setPeak(on)
+        if not on:
+            self.peak.disable()
+
+    def showEnvelope(self, X):
+        # one bucket per pixel column
+        plot = self.scope.plot
+        buckets = plot.canvas().width() or scopewidth
+        if plot.triggerCH:
+            # the envelope of the triggered frame
+            self.peak.disable()
+            if X is None or not X.shape[1]: return
+            mins, maxs = utils.minmax(X, buckets)
+            size = -(-X.shape[1]//buckets)
+        else:
+            # the envelope of every sample since the last tick
+            self.peak.configure(plot.framePoints(), buckets)
+            frames = self.peak.fetch()
+            if frames is None: return
+            mins, maxs = frames
+            size = self.peak.size
+        plot.showEnvelope(mins, maxs, size)
+
+    def triggeredFrame(self, npoints):
+        # the newest frame triggered since the last tick, None if none
+        plot = self.scope.plot
+        ch = plot.triggerCH - 1
+        amps, offsets = plot.channelScales()
+        self.trigger.configure(ch, plot.triggerval*amps[ch, 0],
+                               plot.triggerslope,
+                               hysteresis=TRIGGER_HYSTERESIS*amps[ch, 0],
+                               holdoff=TRIGGER_HOLDOFF*samplerate,
+                               length=npoints,
+                               pretrigger=TRIGGER_PRETRIGGER*npoints)
+        return self.trigger.frame()
+
     def printPlot(self):
         printer = Qt.QPrinter(Qt.QPrinter.HighResolution)
 
@@ -991,24 +1280,102 @@ class FScopeDemo(Qt.QMainWindow):
                 '',
                 'CSV Documents (*.csv)')
 
-        if not fileName.isEmpty():
+        if fileName.isEmpty():
+            return
+        if self.segs is not None and self.segs.done and \
+           self.current is self.scope:
+            self.segs.export(str(fileName), samplerate)
+        else:
+            a = self.current.plot.a
             csvlib.write_csv(fileName, 
                              np.vstack((
-                                        np.arange(self.current.plot.a1.shape[0], dtype=int32)/samplerate,
-                                        self.current.plot.a1, 
-                                        self.current.plot.a2)), 
-                             ("TIME", "CH1", "CH2"))
+                                        np.arange(a.shape[1])/float(samplerate),
+                                        a)), 
+                             ["TIME"] + ["CH%d" % (c + 1) for c in range(a.shape[0])])
+
+    def record(self, on):
+        # stream every acquired sample to disk, not just the displayed frame
+        if on:
+            fileName = Qt.QFileDialog.getSaveFileName(
+                    self,
+                    'Record File Name',
+                    '',
+                    'dualscope123 recordings (*.dsr)')
+            if fileName.isEmpty():
+                self.btnRecord.setChecked(False)
+                return
+            stream = self.datastream
+            self.recorder = recorder.Recorder(str(fileName), stream.RATE,
+                                              stream.CHANNELS, stream.DTYPE)
+            self.recorder.start()
+            stream.add_sink(self.recorder.write)
+            self.btnRecord.setText("Stop")
+            self.showInfo('Recording to %s' % (fileName,))
+        elif self.recorder is not None:
+            self.datastream.remove_sink(self.recorder.write)
+            self.recorder.stop()
+            self.showInfo('Recorded %d samples to %s, %d dropped in %d gaps' %
+                          (self.recorder.samples, self.recorder.path,
+                           self.recorder.dropped, self.recorder.gaps))
+            self.recorder = None
+            self.btnRecord.setText("Record")
+
+    def segments(self, on):
+        # capture a burst of SEGMENTS triggered frames, without redrawing
+        if on:
+            if not self.scope.plot.triggerCH:
+                self.showInfo('Segments: select a trigger channel first')
+                self.btnSegments.setChecked(False)
+                return
+            npoints = int(np.ceil(self.scope.plot.maxtime*samplerate))
+            self.segs = trigger.Segments(SEGMENTS, self.datastream.CHANNELS,
+                                         npoints,
+                                         int(TRIGGER_PRETRIGGER*npoints),
+                                         self.datastream.DTYPE)
+            self.trigger.setCapture(self.segs)
+            self.showInfo('Capturing %d segments' % (SEGMENTS,))
+        elif self.segs is not None:
+            self.trigger.setCapture(None)
+            self.segs = None
+            self.lstSegment.setRange(0, 0)
+            self.lstSegment.setEnabled(False)
+            self.scope.plot.clearOverlay()
+
+    def segmentsProgress(self):
+        if self.trigger.capture is None:
+            # captured already, being browsed
+            return
+        if not self.scope.plot.triggerCH:
+            # the trigger was switched off: cancel, see segments()
+            self.btnSegments.setChecked(False)
+            self.showInfo('Segments: capture cancelled, trigger off')
+            return
+        # follow the trigger knobs during the capture
+        self.triggeredFrame(self.segs.length)
+        if not self.segs.done:
+            self.showInfo('Capturing segments: %d of %d' %
+                          (self.segs.filled, self.segs.count))
+            return
+        self.trigger.setCapture(None)
+        self.lstSegment.setRange(0, self.segs.filled)
+        self.lstSegment.setValue(0)
+        self.lstSegment.setEnabled(True)
+        self.scope.plot.showSegments(self.segs)
+        self.showInfo('Captured %d segments, %d overwritten before copy' %
+                      (self.segs.filled, self.segs.lost))
+
+    def showSegment(self, index):
+        if self.segs is None or not self.segs.done: return
+        self.scope.plot.showSegments(self.segs, index - 1 if index else None)
 
     def channel(self, item):
         global SELECTEDCH
-        if item == 1:
-            SELECTEDCH = CH1
-        elif item == 2:
-            SELECTEDCH = CH2
+        if item == 0:
+            SELECTEDCH = None
         else:
-            SELECTEDCH = BOTH12
-        self.scope.plot.avcount = 0
-        self.pwspec.plot.avcount = 0
+            SELECTEDCH = (item - 1,)
+        self.scope.plot.averager.reset()
+        self.pwspec.plot.averager.reset()
         
     def freeze(self, on, changeIcon=True):
         if on:
@@ -1035,6 +1402,11 @@ class FScopeDemo(Qt.QMainWindow):
             self.btnAvge.setIcon(Qt.QIcon(Qt.QPixmap(icons.avge)))
         self.scope.plot.setAverage(self.averageState)
         self.pwspec.plot.setAverage(self.averageState)
+        self._averaged = None
+
+    def averageMode(self, item):
+        self.scope.plot.averager.setMode(averaging.MODES[item])
+        self.pwspec.plot.averager.setMode(averaging.MODES[item])
 
     def autocorrelation(self, on):
         if on:
@@ -1060,14 +1432,8 @@ class FScopeDemo(Qt.QMainWindow):
             self.btnMode.setText("fft")
             self.btnMode.setIcon(Qt.QIcon(Qt.QPixmap(icons.pwspec)))
             self.btnMode.setChecked(False)
-        if self.changeState==1:
-            self.stack.setCurrentIndex(self.changeState)
-            self.scope.plot.setDatastream(None)
-            self.pwspec.plot.setDatastream(stream)
-        else:
-            self.stack.setCurrentIndex(self.changeState)
-            self.pwspec.plot.setDatastream(None)
-            self.scope.plot.setDatastream(stream)
+        self.stack.setCurrentIndex(self.changeState)
+        self.current.plot.setDirty()
 
     def moved(self, e):
         if self.changeState==1:
@@ -1076,18 +1442,24 @@ class FScopeDemo(Qt.QMainWindow):
             name='Time'
         frequency = self.current.plot.invTransform(Qwt.QwtPlot.xBottom, e.x())
         amplitude = self.current.plot.invTransform(Qwt.QwtPlot.yLeft, e.y())
-        if name=='Time':
+        if name=='Time' and self.scope.plot.envelope is not None:
+            t, y = self.scope.plot.envelope
+            i=min(np.searchsorted(t, frequency), len(t) - 1)
+            amps=y[:, i]
+        elif name=='Time':
             df=self.scope.plot.dt
             i=int(frequency/df)
-            ampa=self.scope.plot.a1[i]
-            ampb=self.scope.plot.a2[i]
+            amps=self.scope.plot.a[:, i]
         else:
-            df=self.pwspec.plot.df
-            i=int(frequency/df)
-            ampa=self.pwspec.plot.a1[i]
-            ampb=self.pwspec.plot.a2[i]
-        self.showInfo('%s=%g, cursor=%g, A=%g, B=%g' %
-                      (name,frequency, amplitude,ampa,ampb))
+            # on the axis itself: in zoom mode it does not start at 0 Hz
+            f=self.pwspec.plot.f
+            n=min(len(f), self.pwspec.plot.a.shape[1])
+            i=min(np.searchsorted(f[:n], frequency), n - 1)
+            amps=self.pwspec.plot.a[:, i]
+        self.showInfo('%s=%g, cursor=%g, %s' %
+                      (name,frequency, amplitude,
+                       ', '.join(['CH%d=%g' % (c + 1, amps[c])
+                                  for c in selected_channels()])))
         
     def appended(self, e):
         print 's'
@@ -1130,23 +1502,89 @@ def load_cfg():
         verbose = True
     else:
         verbose = False
-    return probe_module, verbose
+    return probe_module, verbose, conf
 
 def main():        
-	global verbose, samplerate, CHUNK, fftbuffersize, stream 
-	probe, verbose = load_cfg()
-	stream = probe.Probe()
+	global verbose, samplerate, CHUNK, stream, CHANNELS, MAX_TIMEBASE
+	global TRIGGER_HYSTERESIS, TRIGGER_HOLDOFF, TRIGGER_PRETRIGGER, SEGMENTS
+	global AVERAGING_MODE, AVERAGING_FRAMES, DISPLAY_FPS, FFT_WINDOW
+	global WELCH_SEGMENT, WELCH_OVERLAP, WELCH_SEGMENTS
+	global FFT_BACKEND, FFT_THREADS, SPECTRUM_MODULE, spectrum, ZOOM_POINTS
+	probe, verbose, conf = load_cfg()
+	try:
+		depth = conf.getfloat('acquisition', 'depth')
+	except (ConfigParser.NoSectionError, ConfigParser.NoOptionError):
+		# enough for the longest frame of the Time knob
+		depth = max(acquisition.DEFAULT_DEPTH, 2*10.0*MAX_TIMEBASE)
+	if conf.has_option('trigger', 'hysteresis'):
+		TRIGGER_HYSTERESIS = conf.getfloat('trigger', 'hysteresis')
+	if conf.has_option('trigger', 'holdoff'):
+		TRIGGER_HOLDOFF = conf.getfloat('trigger', 'holdoff')
+	if conf.has_option('trigger', 'pretrigger'):
+		TRIGGER_PRETRIGGER = conf.getfloat('trigger', 'pretrigger')
+	if conf.has_option('segments', 'count'):
+		SEGMENTS = conf.getint('segments', 'count')
+	if conf.has_option('averaging', 'mode'):
+		AVERAGING_MODE = conf.get('averaging', 'mode').strip("\"'").strip()
+		if not AVERAGING_MODE in averaging.MODES:
+			print "(WW) Unknown averaging mode %s, using %s." % \
+			      (AVERAGING_MODE, averaging.CUMULATIVE)
+			AVERAGING_MODE = averaging.CUMULATIVE
+	if conf.has_option('averaging', 'frames'):
+		AVERAGING_FRAMES = conf.getint('averaging', 'frames')
+	if conf.has_option('display', 'fps'):
+		DISPLAY_FPS = max(conf.getfloat('display', 'fps'), 1.0)
+	if conf.has_option('fft', 'window'):
+		FFT_WINDOW = conf.get('fft', 'window').strip("\"'").strip()
+		if not FFT_WINDOW in psd.WINDOWS:
+			print "(WW) Unknown FFT window %s, using %s." % \
+			      (FFT_WINDOW, psd.DEFAULT_WINDOW)
+			FFT_WINDOW = psd.DEFAULT_WINDOW
+	if conf.has_option('fft', 'segment'):
+		WELCH_SEGMENT = conf.getint('fft', 'segment')
+	if conf.has_option('fft', 'overlap'):
+		WELCH_OVERLAP = conf.getfloat('fft', 'overlap')
+	if conf.has_option('fft', 'segments'):
+		WELCH_SEGMENTS = conf.getint('fft', 'segments')
+	if conf.has_option('fft', 'zoom'):
+		ZOOM_POINTS = max(conf.getint('fft', 'zoom'), 16)
+	if conf.has_option('fft', 'backend'):
+		FFT_BACKEND = conf.get('fft', 'backend').strip("\"'").strip()
+	if conf.has_option('fft', 'threads'):
+		FFT_THREADS = conf.getint('fft', 'threads')
+	if FFT_BACKEND == 'pyspectrum':
+		try:
+			spectrum = importlib.import_module('spectrum')
+			print "(II) spectrum MODULE FOUND"
+			SPECTRUM_MODULE = True
+		except ImportError:
+			print "(WW) PSD: spectrum MODULE NOT FOUND"
+		# the Welch estimator runs on FFTs in any case
+		FFT_BACKEND = 'auto'
+	# the probe is read in a background thread, the widgets pull frames
+	# from the acquisition ring buffer
+	stream = acquisition.Acquisition(probe.Probe(), depth, verbose)
 	stream.open()
 	samplerate = stream.RATE
+	CHANNELS = stream.CHANNELS
 	CHUNK = stream.CHUNK
-	fftbuffersize = CHUNK
+	limit = stream.capacity/(2*10.0*samplerate)
+	if limit < MAX_TIMEBASE:
+		print "(WW) Acquisition depth %g s: timebase limited to %g s/div." \
+		      % (depth, limit)
+		MAX_TIMEBASE = limit
+	# the default scope frame and the Welch segments
+	FFT_BACKEND = choose_fft_backend(FFT_BACKEND, FFT_THREADS,
+	                                 (int(np.ceil(0.1*samplerate)),
+	                                  WELCH_SEGMENT))
 
 	app = Qt.QApplication(sys.argv)
 	demo = FScopeDemo()
-	demo.scope.plot.setDatastream(stream)
+	demo.setDatastream(stream)
 	demo.show()
 
 	app.exec_()
+	demo.record(False)
 	stream.close()
 
 if __name__ == '__main__':
@@ -1,39 +1,156 @@
+"""
+Sound card probe.
+
+The PyAudio stream runs in callback mode: PortAudio hands every block to
+_callback() from its own thread, which only copies it into a ring buffer
+and returns. Nothing blocks the sound card, and latest() returns the
+newest samples immediately. read() and read_into() consume the stream in
+order, waiting for the samples that were not captured yet.
+
+Blocks flagged by PortAudio as input overflows or underflows are counted
+in self.stats, together with the samples lost because the reader fell
+more than a ring buffer behind. Configuration, in ~/.dualscope123:
+
+	[audio]
+	rate = 44100   ; depends on sound card: 96000 might be possible
+	chunk = 1024   ; frames per callback
+	depth = 1.0    ; seconds of samples kept in the ring buffer
+"""
 from .generic import GenericProbe
+from ..acquisition import RingBuffer
+import os.path, ConfigParser
+import threading
 import numpy
 import pyaudio
 
 class Probe(GenericProbe):
+	API_VERSION = 2   # read_into(), DTYPE, MAX_RATE
+
 	def __init__(self):
 		# audio setup
-		self.CHUNK = 8192    # input buffer size in frames
+		self.CHUNK = 1024    # frames per callback
 		self.FORMAT = pyaudio.paInt16
+		self.DTYPE = numpy.int16   # numpy equivalent of FORMAT
 		self.CHANNELS = 2
 		self.RATE = 44100    # depends on sound card: 96000 might be possible
+		self.MAX_RATE = 96000
+		self.DEPTH = 1.0     # s
 		self.p = None
+		self.stream = None
+		self.ring = None
+		self.position = 0L   # next sample returned by read_into()
+		self._available = threading.Condition()
+		self._closed = False
+		self.stats = {'overflows': 0, 'underruns': 0, 'lost': 0L}
 
 	def open(self):
+		conf_path = os.path.expanduser('~/.dualscope123')
+		conf = ConfigParser.ConfigParser()
+		conf.read([conf_path])
+		if conf.has_option('audio', 'rate'):
+			self.RATE = conf.getint('audio', 'rate')
+		if conf.has_option('audio', 'chunk'):
+			self.CHUNK = conf.getint('audio', 'chunk')
+		if conf.has_option('audio', 'depth'):
+			self.DEPTH = conf.getfloat('audio', 'depth')
+		size = max(int(self.DEPTH*self.RATE), 4*self.CHUNK)
+		self.ring = RingBuffer(self.CHANNELS, size, self.DTYPE)
+		self.position = 0L
+		self.stats = {'overflows': 0, 'underruns': 0, 'lost': 0L}
+		self._closed = False
 		# open sound card data stream
 		self.p = pyaudio.PyAudio()
 		self.stream = self.p.open(format=self.FORMAT,
 				channels=self.CHANNELS,
 				rate=self.RATE,
 				input=True,
-				frames_per_buffer=self.CHUNK)
-
-	def read(self, channel, npoints, verbose=False):
-		#nchunks = int(npoints/self.CHUNK) + 1*(npoints % self.CHUNK > 0)
-		x = self.stream.read(npoints)
-		X = numpy.fromstring(x, dtype='h')
-		X = numpy.array(X, numpy.int32)
-		if str(channel) == '1':
-			return X[::2]
-		if str(channel) == '2':
-			return X[1::2]
-		if str(channel) == '12':
-			return X[::2], X[1::2]
+				frames_per_buffer=self.CHUNK,
+				stream_callback=self._callback)
+		self.stream.start_stream()
+
+	def _callback(self, in_data, frame_count, time_info, status):
+		# runs in the PortAudio thread: copy and return, nothing else
+		if status & pyaudio.paInputOverflow:
+			self.stats['overflows'] += 1
+		if status & pyaudio.paInputUnderflow:
+			self.stats['underruns'] += 1
+		# de-interleave while copying into the ring buffer
+		X = numpy.frombuffer(in_data, dtype=self.DTYPE).reshape(-1, self.CHANNELS)
+		self.ring.write(X.T)
+		with self._available:
+			self._available.notify_all()
+		return (None, pyaudio.paContinue)
+
+	def latest(self, npoints):
+		"""Return the newest npoints frames as a (CHANNELS, npoints) array,
+		without waiting. Returns None if they were not captured yet."""
+		return self.ring.latest(npoints)
+
+	def read_into(self, buffers, npoints=None, verbose=False):
+		"""Read the next frames straight into caller-owned buffers.
+
+		Args:
+
+		 * buffers is an array-like with one row per channel, e.g. a
+		   (CHANNELS, N) numpy array, preallocated by the caller. The
+		   samples are converted to the dtype of the buffers, if it
+		   differs from the native DTYPE.
+		 * npoints (int) is the number of frames to read, defaults to
+		   the length of the buffers.
+
+		Waits until the frames are captured. If the reader fell so far
+		behind that they were overwritten, it skips to the oldest frames
+		still available and counts the lost ones in stats['lost']. If the
+		stream stops, or the probe is closed, while waiting, it returns
+		the frames captured so far, or raises IOError if there are none.
+
+		Returns the number of frames read.
+		"""
+		if npoints is None:
+			npoints = len(buffers[0])
+		npoints = min(npoints, self.ring.size - self.CHUNK)
+		# straight from the ring buffer into numpy buffers of the native
+		# dtype, e.g. the views of the acquisition ring buffer
+		direct = isinstance(buffers, numpy.ndarray) and \
+		         buffers.dtype == self.DTYPE and buffers.ndim == 2 and \
+		         buffers.shape[0] == self.CHANNELS
+		with self._available:
+			while self.ring.written < self.position + npoints:
+				if self._closed or not self.stream.is_active():
+					npoints = self.ring.written - self.position
+					if npoints <= 0:
+						raise IOError("audio: the input stream stopped.")
+					break
+				self._available.wait(1.0)
+		while True:
+			oldest = self.ring.written - self.ring.size + self.CHUNK
+			if self.position < oldest:
+				self.stats['lost'] += oldest - self.position
+				self.position = oldest
+			if direct:
+				X = self.ring.read(self.position, npoints,
+				                   buffers[:, :npoints])
+			else:
+				X = self.ring.read(self.position, npoints)
+			if X is not None:
+				break
+		if not direct:
+			for c in range(self.CHANNELS):
+				buffers[c][:npoints] = X[c]
+		self.position += npoints
+		if verbose and (self.stats['overflows'] or self.stats['lost']):
+			print "audio: %(overflows)d input overflows, " \
+			      "%(underruns)d underruns, %(lost)d samples lost" % self.stats
+		return npoints
 
 	def close(self):
+		# wake up a reader waiting for samples that will not come
+		with self._available:
+			self._closed = True
+			self._available.notify_all()
 		self.stream.stop_stream()
 		self.stream.close()
 		self.p.terminate()
-
+		if self.stats['overflows'] or self.stats['lost']:
+			print "(WW) audio: %(overflows)d input overflows, " \
+			      "%(lost)d samples lost." % self.stats
@@ -1,7 +1,7 @@
 from generic import GenericProbe
 import ctypes, os
 import os.path, ConfigParser
-import time, struct
+import time, threading, Queue
 import numpy as np
 
 libname = "libethc.so"
@@ -11,16 +11,45 @@ _libfunctions = ctypes.cdll.LoadLibrary(fullpath)
 # *read_nios(char *hostname, int port, int ch_number, int chunks_count)
 _libfunctions.read_nios.argtypes = [ctypes.c_char_p, ctypes.c_int,  ctypes.c_int,  ctypes.c_int]
 _libfunctions.read_nios.restype  =  ctypes.c_char_p
+# int read_nios_into(char *hostname, int port, int ch_number, int chunks_count, int *out)
+_libfunctions.read_nios_into.argtypes = [ctypes.c_char_p, ctypes.c_int,  ctypes.c_int,  ctypes.c_int,
+                                         np.ctypeslib.ndpointer(dtype=np.int32, ndim=1,
+                                                                flags='C_CONTIGUOUS,WRITEABLE')]
+_libfunctions.read_nios_into.restype  =  ctypes.c_int
+# int nios_open(char *hostname, int port)
+_libfunctions.nios_open.argtypes = [ctypes.c_char_p, ctypes.c_int]
+_libfunctions.nios_open.restype  =  ctypes.c_int
+# int nios_read_into(int sock, int ch_number, int chunks_count, int *out)
+_libfunctions.nios_read_into.argtypes = [ctypes.c_int,  ctypes.c_int,  ctypes.c_int,
+                                         np.ctypeslib.ndpointer(dtype=np.int32, ndim=1,
+                                                                flags='C_CONTIGUOUS,WRITEABLE')]
+_libfunctions.nios_read_into.restype  =  ctypes.c_int
+# void nios_close(int sock)
+_libfunctions.nios_close.argtypes = [ctypes.c_int]
+_libfunctions.nios_close.restype  =  None
+
+# reconnection policy: exponential backoff, from BACKOFF_START to BACKOFF_MAX
+# seconds between attempts
+RECONNECT_ATTEMPTS = 6
+BACKOFF_START = 0.05
+BACKOFF_MAX = 2.0
 
 class Probe(GenericProbe):
+	API_VERSION = 2   # read_into(), DTYPE, MAX_RATE
+
 	def __init__(self):
 		# ADC test-bench read-out over ethernet.
 		self.CHUNK = 350    # input buffer size in frames
 		self.FORMAT = int   # Python int
+		self.DTYPE = np.int32   # samples are sign-extended 22-bit words
 		self.CHANNELS = 2
 		self.RATE = 25000
+		self.MAX_RATE = 25000
 		self.HOSTNAME = None
 		self.port = None
+		self.stats = {}
+		self._workers = {}
+		self._sockets = {}
 
 	def open(self):
 		conf_path = os.path.expanduser('~/.dualscope123')
@@ -36,9 +65,14 @@ class Probe(GenericProbe):
 			      "eth_nios with hostname and port")
 		self.HOSTNAME = conf.get('eth_nios', 'hostname').strip("\"'")
         	self.PORT = conf.get('eth_nios', 'port').strip("\"'")
+		# one persistent connection and read-out worker per channel
+		for c in range(1, self.CHANNELS + 1):
+			self._connect(c)
+			self._workers[c] = _ChannelWorker(self, c)
+			self._workers[c].start()
 
 
-	def read(self, channel, npoints, verbose):
+	def read(self, channel, npoints, verbose=False):
                 """Read 'nchunks' chunks from channel 'channel'.
 
                 Args:
@@ -53,26 +87,156 @@ class Probe(GenericProbe):
 		nchunks = int(npoints/self.CHUNK) + 1*(npoints % self.CHUNK > 0)
 
 		channels = [int(c) for c in str(channel)]
-		data = []
-
-		for c in channels:
-			if verbose:
-				print "Starting: %s %s %s %s" % \
-                		    (self.HOSTNAME, int(self.PORT), int(c), int(nchunks))
-			start_time = time.time()
-			x = _libfunctions.read_nios(self.HOSTNAME, int(self.PORT), int(c)-1, int(nchunks))
-			end_time = time.time()
-			if verbose:
-				print "CH%d: received %d bytes (%d frames, %d chunks) at %d kbps" % \
-                              (c, len(x)/2, len(x)/8, len(x)/8/350,
-                               4e-3*len(x)/(end_time - start_time))
-			data += [np.array(struct.unpack('<'+('i'*nchunks*self.CHUNK), x.decode('hex')))]
-			if verbose:
-				print data[-1]
+		data = [np.empty((nchunks*self.CHUNK,), dtype=self.DTYPE)
+		        for c in channels]
+		self._read_channels(zip(channels, data), nchunks, verbose)
+		if verbose:
+			for x in data:
+				print x
 		return data
 
+	def read_into(self, buffers, npoints=None, verbose=False):
+		"""Read 'npoints' samples of every channel into 'buffers'.
+
+		The samples are received in binary form directly in the buffers,
+		if they are C-contiguous int32 arrays and npoints is a multiple
+		of CHUNK, otherwise they are read in a temporary array first.
+
+		Returns the number of samples read per channel.
+		"""
+		if npoints is None:
+			npoints = len(buffers[0])
+		nchunks = int(npoints/self.CHUNK) + 1*(npoints % self.CHUNK > 0)
+		jobs, copies = [], []
+		for c in range(self.CHANNELS):
+			buf = buffers[c]
+			if nchunks*self.CHUNK == npoints and isinstance(buf, np.ndarray) \
+			   and buf.dtype == self.DTYPE and buf.flags.c_contiguous:
+				jobs.append((c + 1, buf[:npoints]))
+			else:
+				x = np.empty((nchunks*self.CHUNK,), dtype=self.DTYPE)
+				jobs.append((c + 1, x))
+				copies.append((buf, x))
+		self._read_channels(jobs, nchunks, verbose)
+		for buf, x in copies:
+			buf[:npoints] = x[:npoints]
+		return npoints
+
+	def _read_channels(self, jobs, nchunks, verbose=False):
+		"""Run the (channel, out) read-out jobs concurrently.
+
+		Every channel is read by its own worker thread, the GIL is
+		released during the ctypes call so that the transfers overlap.
+		Timing information is stored in self.stats.
+		"""
+		start_time = time.time()
+		if len(jobs) == 1:
+			c, out = jobs[0]
+			timings = [self._read_channel(c, nchunks, out, verbose)]
+		else:
+			for c, out in jobs:
+				self._workers[c].requests.put((nchunks, out, verbose))
+			timings, error = [], None
+			for c, out in jobs:
+				timing, e = self._workers[c].results.get()
+				if e is not None:
+					error = e
+				else:
+					timings.append(timing)
+			if error is not None:
+				raise error
+		end_time = time.time()
+		self.stats['read_time'] = end_time - start_time
+		self.stats['channel_times'] = dict([(c, t[1] - t[0]) for c, t in
+		                                    zip([j[0] for j in jobs], timings)])
+		starts = [t[0] for t in timings]
+		self.stats['start_skew'] = max(starts) - min(starts)
+		self.stats['samples_per_s'] = len(jobs)*nchunks*self.CHUNK / \
+		                              (end_time - start_time)
+		if verbose:
+			print "Read %d channels in %g s, start skew %g s" % \
+			      (len(jobs), self.stats['read_time'], self.stats['start_skew'])
+
+	def _read_channel(self, c, nchunks, out, verbose=False):
+		"""Fill 'out' with 'nchunks' chunks of channel 'c' (1-based).
+
+		Returns the (start, end) times of the transfer.
+		"""
+		if verbose:
+			print "Starting: %s %s %s %s" % \
+			    (self.HOSTNAME, int(self.PORT), int(c), int(nchunks))
+		start_time = time.time()
+		for attempt in range(2):
+			sock = self._connect(c)
+			n = _libfunctions.nios_read_into(sock, int(c)-1, int(nchunks), out)
+			if n >= 0:
+				break
+			# stale connection, e.g. closed by the server: reopen it
+			self._disconnect(c)
+		end_time = time.time()
+		if n < 0:
+			raise IOError("CH%d: read-out from %s:%s failed." %
+			              (c, self.HOSTNAME, self.PORT))
+		if verbose:
+			print "CH%d: received %d bytes (%d frames, %d chunks) at %d kbps" % \
+			      (c, 4*n, n, n/self.CHUNK,
+			       32e-3*n/(end_time - start_time))
+		return start_time, end_time
+
+	def _connect(self, c):
+		"""Return the connection of channel 'c', (re)opening it if needed."""
+		sock = self._sockets.get(c, -1)
+		if sock >= 0:
+			return sock
+		delay = BACKOFF_START
+		for attempt in range(RECONNECT_ATTEMPTS):
+			sock = _libfunctions.nios_open(self.HOSTNAME, int(self.PORT))
+			if sock >= 0:
+				self._sockets[c] = sock
+				return sock
+			print "(WW) eth_nios: CH%d: cannot connect to %s:%s, retrying in %g s" % \
+			      (c, self.HOSTNAME, self.PORT, delay)
+			time.sleep(delay)
+			delay = min(2*delay, BACKOFF_MAX)
+		raise IOError("CH%d: cannot connect to %s:%s." %
+		              (c, self.HOSTNAME, self.PORT))
+
+	def _disconnect(self, c):
+		sock = self._sockets.pop(c, -1)
+		if sock >= 0:
+			_libfunctions.nios_close(sock)
+
 	def close(self):
-		pass
+		for worker in self._workers.values():
+			worker.requests.put(None)
+		for worker in self._workers.values():
+			worker.join()
+		self._workers = {}
+		for c in self._sockets.keys():
+			self._disconnect(c)
+
+class _ChannelWorker(threading.Thread):
+	"""Reads one channel of the probe, whenever a request is queued."""
+	def __init__(self, probe, channel):
+		threading.Thread.__init__(self, name="eth_nios-CH%d" % channel)
+		self.daemon = True
+		self.probe = probe
+		self.channel = channel
+		self.requests = Queue.Queue()
+		self.results = Queue.Queue()
+
+	def run(self):
+		while True:
+			request = self.requests.get()
+			if request is None:
+				break
+			nchunks, out, verbose = request
+			try:
+				timing = self.probe._read_channel(self.channel, nchunks,
+				                                  out, verbose)
+				self.results.put((timing, None))
+			except Exception, e:
+				self.results.put((None, e))
 
 def autosetup():
         """If you're in a hurry, this function will create an interface for you,
@@ -12,6 +12,7 @@
 #include <string.h>
 #include <signal.h>
 #include <netinet/in.h>
+#include <netinet/tcp.h>
 #include <netdb.h>
 #include <sys/socket.h>
 #include <pthread.h>
@@ -33,56 +34,29 @@ void print_raw(char *buffer, const void *object, size_t size)
 	return;
 }
 
-char *read_nios(char *hostname, int port, int ch_number, int chunks_count)
+/* Opens a TCP connection to the NIOS server, which may be kept open */
+/* across several nios_read_into() calls. */
+/* Returns the socket descriptor, or -1 on error. */
+int nios_open(char *hostname, int port)
 {
-	int sock, i, j;
-	long int n, nold;
-	/* const struct sockaddr serv_addr; */
+	int sock;
+	int nodelay = 1;
 	struct sockaddr_in serv_addr;
 	struct hostent *server;
-	
-	char *buffer;
-	char *ret;
-	
-	signed int acq_data_cast;
-	
-	unsigned int acq_data;
-	unsigned int chunk_size = 350;
-	unsigned int data_count;
-	unsigned char start_stop;
-	unsigned char data_type;
-	
-	unsigned char payload_counter;
-	unsigned int error_counter;
-	unsigned int requests_counter;
-	unsigned int frame_number;
-	
-	unsigned char command[4];
-	
-	struct timeval t_start;
-	struct timeval t_end;
-	long int read_time_us;
-	
-	unsigned int points;
-	double data_mean;
-	int data_max;
-	int data_min;
-	int suppress_count = 5;
-	
-	signed short prev_sample;
-	
+
 	/* create socket */
 	if((sock = socket(AF_INET, SOCK_STREAM, 0)) < 0)
 	{
 		perror("socket");
-		exit(EXIT_FAILURE);
+		return -1;
 	}
 
 	server = gethostbyname(hostname);
 
 	if (server == NULL) {
 		fprintf(stderr,"ERROR, no such host\n");
-		exit(0);
+		close(sock);
+		return -1;
 	}
 
 	bzero((char *) &serv_addr, sizeof(serv_addr));
@@ -93,37 +67,53 @@ char *read_nios(char *hostname, int port, int ch_number, int chunks_count)
 	serv_addr.sin_port = htons(port);
 	
 	/* Now connect to the server */
-	if (connect(sock, &serv_addr, sizeof(serv_addr)) < 0) 
+	if (connect(sock, (struct sockaddr *) &serv_addr, sizeof(serv_addr)) < 0) 
 	{
 		 perror("ERROR connecting");
-		 exit(1);
-	}	
-	
-	error_counter = 0;
-	requests_counter = 0;
+		 close(sock);
+		 return -1;
+	}
+	/* the 4 bytes commands should not wait for more data */
+	setsockopt(sock, IPPROTO_TCP, TCP_NODELAY, (char *) &nodelay, sizeof(nodelay));
+	return sock;
+}
+
+/* Closes a connection opened by nios_open(). */
+void nios_close(int sock)
+{
+	close(sock);
+}
+
+/* Asks the server for chunks_count chunks of channel ch_number over sock */
+/* and stores the samples, sign extended to 32 bits, in out, which must */
+/* hold chunks_count*350 ints. The raw big-endian words are received in */
+/* out itself and decoded in place. */
+/* Returns the number of samples read, or -1 on error, in which case the */
+/* connection should be closed and reopened. */
+int nios_read_into(int sock, int ch_number, int chunks_count, int *out)
+{
+	int i;
+	long int n, nold, data_count;
+	unsigned char *buffer = (unsigned char *) out;
+
+	signed int acq_data_cast;
+	unsigned int acq_data;
+	unsigned int chunk_size = 350;
+	unsigned char start_stop;
+	unsigned char data_type;
+
+	unsigned char payload_counter;
+	unsigned int error_counter;
+	unsigned char command[4];
+	int suppress_count = 5;
 
 	if (ch_number < 0 || ch_number >7){
-		perror("ERROR: channels go from 0 to 7.");
-		exit(1);
+		fprintf(stderr, "ERROR: channels go from 0 to 7.\n");
+		return -1;
 	}
-		
 
-	data_count = chunks_count*chunk_size*4;
-	buffer = (char*)malloc(data_count);
-	if (buffer==NULL) 
-	{
-		perror("ERROR allocating READ buffer");
-		exit(1);
-	}
-	bzero(buffer, data_count);
-	ret = (char*)malloc(data_count*2);
-	if (ret==NULL) 
-	{
-		perror("ERROR allocating DATA buffer");
-		exit(1);
-	}
-	bzero(ret, 2*data_count);
-	
+	data_count = (long int) chunks_count*chunk_size*4;
+
 	/* Send command to the server */
 	start_stop = 1;
 	data_type = 0;
@@ -133,40 +123,34 @@ char *read_nios(char *hostname, int port, int ch_number, int chunks_count)
 	command[2] = (unsigned char)((chunks_count&0xFF00)>>8);
 	command[3] = (unsigned char)(chunks_count&0xFF);
 		
-	/* printf("command = %x %x %x %x\n", command[0], command[1], command[2], command[3]); */
-		
 	n = (long int) write(sock,command,4);
 	if (n < 0) 
 	{
 		 perror("ERROR writing to socket");
-		 exit(1);
+		 return -1;
 	}
 		
 	/* Now read server response */
-		
-	n = 0L; /* read(sock, buffer, data_count); */
+	n = 0L;
 	nold = 0L;
-	payload_counter = 0;
-
 	while(n<data_count)
 	{
 		n += (long int) read(sock, buffer+n, data_count-n);
 		if (n <= nold) 
 		{
 			 perror("ERROR reading from socket");
-			 exit(1);
+			 return -1;
 		}
 		nold = n;
 	}
-		
+
+	error_counter = 0;
+	payload_counter = 0;
 	for(i=0; i < chunks_count*chunk_size; i++)
 	{
 		acq_data = (buffer[i*4]&0xFF)<<24 | (buffer[i*4+1]&0xFF)<<16 | (buffer[i*4+2]&0xFF)<<8 | (buffer[i*4+3]&0xFF) ;
 		acq_data_cast = (signed int)((acq_data&0x003FFFFF) << 11);
-		acq_data_cast = acq_data_cast >> 11;
-		frame_number = (unsigned int)(acq_data&0x07E00000)>>21;
-		
-		print_raw(&ret[8*i], &acq_data_cast, 4);
+		out[i] = acq_data_cast >> 11;
 		/* check if some data was lost */
 		if( payload_counter != ((acq_data>>21)&0x3F) )
 		{
@@ -184,14 +168,57 @@ char *read_nios(char *hostname, int port, int ch_number, int chunks_count)
 		payload_counter >>= 2;
 	}
 	if (error_counter > suppress_count)
-		fprintf(stderr, "%d errors have been suppressed.\n", error_counter, requests_counter);
-	/* print_raw(buffer, data_count); */
-	/* printf("%s", (char *) buffer); */
-	close(sock);
-	free(buffer);
+		fprintf(stderr, "%d errors have been suppressed.\n", error_counter - suppress_count);
+	return chunks_count*chunk_size;
+}
+
+/* Binary read-out over a new connection: stores chunks_count*350 samples */
+/* of channel ch_number in the caller-owned buffer out. */
+/* Returns the number of samples read, or -1 on error. */
+int read_nios_into(char *hostname, int port, int ch_number, int chunks_count, int *out)
+{
+	int sock, n;
+
+	sock = nios_open(hostname, port);
+	if (sock < 0)
+		return -1;
+	n = nios_read_into(sock, ch_number, chunks_count, out);
+	nios_close(sock);
+	return n;
+}
+
+/* Hex read-out: returns a malloc'd string with the samples, 8 hex digits */
+/* per sample, in host byte order. The caller owns the string. */
+char *read_nios(char *hostname, int port, int ch_number, int chunks_count)
+{
+	int i, n;
+	unsigned int chunk_size = 350;
+	int *data;
+	char *ret;
+
+	data = (int*)malloc(chunks_count*chunk_size*sizeof(int));
+	if (data==NULL) 
+	{
+		perror("ERROR allocating READ buffer");
+		exit(1);
+	}
+	ret = (char*)malloc(chunks_count*chunk_size*8 + 1);
+	if (ret==NULL) 
+	{
+		perror("ERROR allocating DATA buffer");
+		exit(1);
+	}
+	n = read_nios_into(hostname, port, ch_number, chunks_count, data);
+	if (n < 0)
+		exit(1);
+	for(i=0; i < n; i++)
+		print_raw(&ret[8*i], &data[i], 4);
+	ret[8*n] = '\0';
+	free(data);
 	
 	return ret;
 }
+
 int main(int argc,char** argv)
 {
 	int port, ch_number, chunks_count;
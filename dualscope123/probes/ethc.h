@@ -22,4 +22,8 @@
 #include <math.h>
 
 void print_raw(char *buffer, const void *object, size_t size);
+int nios_open(char *hostname, int port);
+int nios_read_into(int sock, int ch_number, int chunks_count, int *out);
+void nios_close(int sock);
 char *read_nios(char *hostname, int port, int ch_number, int chunks_count);
+int read_nios_into(char *hostname, int port, int ch_number, int chunks_count, int *out);
@@ -1,10 +1,26 @@
+import numpy
+
+# Version of the probe interface.
+#  1: open(), read(channel, npoints, verbose), close() and the CHUNK,
+#     FORMAT, CHANNELS, RATE attributes.
+#  2: adds read_into(buffers, npoints, verbose), the DTYPE and MAX_RATE
+#     attributes and capabilities().
+# Probes declare the version they implement with an API_VERSION class
+# attribute; GenericProbe, and the probes inheriting it without setting
+# it, are version 1.
+API_VERSION = 2
+
 class GenericProbe():
+	API_VERSION = 1
+
 	def __init__(self):
 		# audio setup
-		self.CHUNK = None    # input buffer size in frames
+		self.CHUNK = None    # input buffer size in frames, the preferred block size
 		self.FORMAT = None   # data format
-		self.CHANNELS = 2    # nchannels, up to two channels are supported
+		self.DTYPE = None    # numpy dtype of the samples, as acquired
+		self.CHANNELS = 2    # nchannels
 		self.RATE = None     # depends on input device, units 1/s
+		self.MAX_RATE = None # the highest RATE supported, units 1/s
 		self.p = None
 		raise Exception('Generic, non-functional probe meant for development!')
 
@@ -12,7 +28,73 @@ class GenericProbe():
 		pass
 
 	def read(self, channel, npoints, verbose=False):
-		pass
+		"""Read 'npoints' samples of 'channel', e.g. 1, or of several
+		channels, e.g. 12, returned as a tuple of arrays.
+
+		Version 2 probes get this through read_into(). Version 1 probes
+		must override it.
+		"""
+		if self.API_VERSION < 2:
+			return None
+		data = numpy.empty((self.CHANNELS, npoints), dtype=self.DTYPE)
+		n = self.read_into(data, npoints, verbose)
+		data = data[:, :n]
+		if len(str(channel)) == 1:
+			return data[int(channel) - 1]
+		return tuple([data[int(c) - 1] for c in str(channel)])
+
+	def read_into(self, buffers, npoints=None, verbose=False):
+		"""Read the next 'npoints' samples of every channel into 'buffers'.
+
+		'buffers' has one row per channel, e.g. a preallocated
+		(CHANNELS, npoints) numpy array. npoints defaults to the length
+		of the rows.
+
+		Returns the number of samples read per channel.
+
+		This fallback goes through read(), probes should override it to
+		fill the buffers directly.
+		"""
+		if npoints is None:
+			npoints = len(buffers[0])
+		channel = ''.join([str(c + 1) for c in range(self.CHANNELS)])
+		data = self.read(channel, npoints, verbose)
+		if data is None:
+			return 0
+		if self.CHANNELS == 1:
+			data = (data,)
+		n = min([npoints] + [len(d) for d in data])
+		for c in range(self.CHANNELS):
+			buffers[c][:n] = data[c][:n]
+		return n
+
+	def capabilities(self):
+		return capabilities(self)
 
 	def close(self):
 		pass
+
+def capabilities(probe):
+	"""Describe an open probe.
+
+	Works with probes implementing any version of the interface.
+
+	Returns a dictionary with the keys:
+	 * api_version: the interface version implemented,
+	 * dtype: the numpy dtype of the samples,
+	 * blocksize: the preferred number of samples per read,
+	 * rate, max_rate: the current and the highest sample rate,
+	 * channels: the number of channels.
+	"""
+	api_version = getattr(probe, 'API_VERSION', 1)
+	dtype = getattr(probe, 'DTYPE', None)
+	if api_version < 2 or dtype is None:
+		# version 1 probes return Python or numpy ints
+		dtype = numpy.int32
+	max_rate = getattr(probe, 'MAX_RATE', None)
+	return {'api_version': api_version,
+		'dtype': numpy.dtype(dtype),
+		'blocksize': probe.CHUNK,
+		'rate': probe.RATE,
+		'max_rate': max_rate if max_rate is not None else probe.RATE,
+		'channels': probe.CHANNELS}
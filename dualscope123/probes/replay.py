@@ -0,0 +1,124 @@
+"""
+Replay probe: serves a recording made with the Record button.
+
+The recording is memory mapped, not loaded, so captures larger than the
+available RAM can be replayed. The samples dropped while recording, listed
+in the .gaps file of the recording, are replayed as zeros, so that the
+replay keeps the time base of the capture. Configuration, in
+~/.dualscope123:
+
+	[replay]
+	file = ~/capture.dsr
+	speed = 1      ; 1 is real time, 10 ten times faster, 0 as fast as possible
+	loop = true    ; restart from the beginning at the end of the file
+	chunk = 4096   ; samples per channel per block
+"""
+from .generic import GenericProbe
+from .. import recorder
+import os.path, ConfigParser
+import time
+import numpy as np
+
+class Probe(GenericProbe):
+	API_VERSION = 2   # read_into(), DTYPE, MAX_RATE
+
+	def __init__(self):
+		# the rate, channels and dtype are read from the recording
+		self.CHUNK = 4096
+		self.FORMAT = int
+		self.DTYPE = None
+		self.CHANNELS = None
+		self.RATE = None
+		self.MAX_RATE = None
+		self.FILE = None
+		self.SPEED = 1.0
+		self.LOOP = True
+		self.data = None
+		self.meta = None
+		self.length = 0L     # samples replayed per loop, gaps included
+		self.position = 0L   # in the replayed stream, gaps included
+		self._gapstart = None  # positions of the gaps in the replayed stream
+		self._gapend = None
+		self._skipped = None   # samples in the gaps up to the end of each
+		self._served = 0L    # samples served since the last seek
+		self._start_time = None
+
+	def open(self):
+		conf_path = os.path.expanduser('~/.dualscope123')
+		conf = ConfigParser.ConfigParser()
+		conf.read([conf_path])
+		if not conf.has_option('replay', 'file'):
+			raise ConfigParser.NoOptionError('file', 'replay')
+		self.FILE = os.path.expanduser(conf.get('replay', 'file').strip("\"'"))
+		if conf.has_option('replay', 'speed'):
+			self.SPEED = conf.getfloat('replay', 'speed')
+		if conf.has_option('replay', 'loop'):
+			self.LOOP = conf.getboolean('replay', 'loop')
+		if conf.has_option('replay', 'chunk'):
+			self.CHUNK = conf.getint('replay', 'chunk')
+		self.load(self.FILE)
+
+	def load(self, path):
+		"""Memory map the recording at 'path' and rewind."""
+		self.data, self.meta = recorder.load(path)
+		if not len(self.data):
+			raise IOError("%s contains no samples." % (path,))
+		self.RATE = self.MAX_RATE = self.meta['rate']
+		self.CHANNELS = self.meta['channels']
+		self.DTYPE = self.meta['dtype']
+		gaps = self.meta['gaps']
+		# (file position, length) to positions in the replayed stream
+		self._skipped = np.cumsum(gaps[:, 1])
+		self._gapstart = gaps[:, 0] + self._skipped - gaps[:, 1]
+		self._gapend = self._gapstart + gaps[:, 1]
+		self.length = len(self.data) + long(gaps[:, 1].sum())
+		self.seek(0)
+
+	def seek(self, index):
+		"""Continue the replay from sample 'index'."""
+		self.position = long(index) % self.length
+		self._served = 0L
+		self._start_time = time.time()
+
+	def read_into(self, buffers, npoints=None, verbose=False):
+		if npoints is None:
+			npoints = len(buffers[0])
+		length = self.length
+		if not self.LOOP:
+			npoints = min(npoints, length - self.position)
+			if not npoints:
+				# end of the recording, do not spin
+				time.sleep(float(self.CHUNK)/self.RATE)
+				return 0
+		if self.SPEED > 0:
+			delay = (self._served + npoints)/(self.SPEED*self.RATE) - \
+			        (time.time() - self._start_time)
+			if delay > 0:
+				time.sleep(delay)
+		i = 0
+		while i < npoints:
+			# the last gap starting at or before the position
+			k = np.searchsorted(self._gapstart, self.position, 'right') - 1
+			if k >= 0 and self.position < self._gapend[k]:
+				n = min(npoints - i, self._gapend[k] - self.position)
+				for c in range(self.CHANNELS):
+					buffers[c][i:i+n] = 0
+			else:
+				end = self._gapstart[k + 1] if k + 1 < len(self._gapstart) \
+				      else length
+				n = min(npoints - i, end - self.position)
+				start = self.position - (self._skipped[k] if k >= 0 else 0)
+				frames = self.data[start:start + n]
+				for c in range(self.CHANNELS):
+					buffers[c][i:i+n] = frames[:, c]
+			i += n
+			self.position += n
+			if self.position == length and self.LOOP:
+				self.position = 0L
+		self._served += npoints
+		if verbose:
+			print "replay: sample %d of %d" % (self.position, length)
+		return npoints
+
+	def close(self):
+		self.data = None
@@ -0,0 +1,168 @@
+"""
+Synthetic signal probe, for testing and benchmarking without hardware.
+
+Every channel is the sum of a few components, configured in
+~/.dualscope123, e.g.:
+
+	[synthetic]
+	rate = 1000000
+	channels = 2
+	ch1 = sine(1000, 0.5) + noise(0.01)
+	ch2 = square(250, 0.3, 0.2) + glitch(5, 0.9)
+
+Components -- frequencies in Hz, amplitudes relative to full scale:
+
+ * sine(f, a[, phase]), phase in degrees,
+ * multitone(f, n, a): the first n harmonics of f, each of amplitude a/n,
+ * square(f, a[, duty]),
+ * noise(a): gaussian noise, of standard deviation a,
+ * glitch(r, a): single-sample spikes of height a, r per second on average.
+
+One period of the signal (by default 1 s) is computed when the probe is
+opened, frequencies are rounded to multiples of 1/period so that it
+repeats seamlessly, and it is then served with block copies: this
+sustains several MS/s. With realtime set, the samples are served no
+faster than the nominal rate.
+
+Other options: chunk (block size), period (s), fullscale (counts),
+realtime (true/false), seed (for the noise and the glitches).
+"""
+from .generic import GenericProbe
+import os.path, ConfigParser
+import re, time
+import numpy as np
+
+DEFAULT_SIGNALS = ('sine(1000, 0.5) + noise(0.01)',
+                   'square(250, 0.3, 0.2) + glitch(5, 0.9)',
+                   'multitone(500, 5, 0.5)')
+
+_component = re.compile(r'\s*(\w+)\s*\(([^)]*)\)\s*')
+
+def parse_signal(text):
+	"""Parse 'sine(1000, .5) + noise(.01)' into [('sine', [1000., .5]), ...]"""
+	components = []
+	for term in text.split('+'):
+		match = _component.match(term)
+		if match is None or match.end() != len(term):
+			raise ValueError("synthetic: cannot parse signal component '%s'." %
+			                 (term.strip(),))
+		args = [float(a) for a in match.group(2).split(',') if a.strip()]
+		components.append((match.group(1).lower(), args))
+	return components
+
+def generate(components, rate, nsamples, rs):
+	"""Compute nsamples of the signal, as floats relative to full scale.
+
+	The frequencies are rounded to multiples of rate/nsamples, so that the
+	result is one period of a periodic signal.
+	"""
+	df = float(rate)/nsamples
+	# phase in cycles, exact modulo 1 as k is an integer
+	n = np.arange(nsamples)
+	def cycles(f):
+		k = np.round(f/df)
+		return (k*n % nsamples)/float(nsamples)
+	x = np.zeros((nsamples,))
+	for kind, args in components:
+		if kind == 'sine':
+			f, a = args[:2]
+			phase = args[2]/360. if len(args) > 2 else 0.
+			x += a*np.sin(2*np.pi*(cycles(f) + phase))
+		elif kind == 'multitone':
+			f, nh, a = args[0], int(args[1]), args[2]
+			for h in range(1, nh + 1):
+				x += a/nh*np.sin(2*np.pi*cycles(h*f))
+		elif kind == 'square':
+			f, a = args[:2]
+			duty = args[2] if len(args) > 2 else 0.5
+			x += np.where(cycles(f) < duty, a, -a)
+		elif kind == 'noise':
+			x += args[0]*rs.standard_normal(nsamples)
+		elif kind == 'glitch':
+			r, a = args[:2]
+			count = rs.poisson(r*nsamples/float(rate))
+			x[rs.randint(0, nsamples, count)] = a
+		else:
+			raise ValueError("synthetic: unknown signal component '%s'." % kind)
+	return x
+
+class Probe(GenericProbe):
+	API_VERSION = 2   # read_into(), DTYPE, MAX_RATE
+
+	def __init__(self):
+		self.CHUNK = 65536   # samples per channel per block
+		self.FORMAT = int
+		self.DTYPE = np.int32
+		self.CHANNELS = 2
+		self.RATE = 1000000
+		self.MAX_RATE = None # no limit, really
+		self.PERIOD = 1.0    # s
+		self.FULLSCALE = 2**20
+		self.REALTIME = True
+		self.SEED = 0
+		self.signals = list(DEFAULT_SIGNALS)
+		self.table = None
+		self._position = 0
+		self._start_time = None
+
+	def open(self):
+		conf_path = os.path.expanduser('~/.dualscope123')
+		conf = ConfigParser.ConfigParser()
+		conf.read([conf_path])
+		if 'synthetic' in conf.sections():
+			get = lambda option, getter: getter('synthetic', option) \
+			          if conf.has_option('synthetic', option) else None
+			self.RATE = get('rate', conf.getint) or self.RATE
+			self.CHANNELS = get('channels', conf.getint) or self.CHANNELS
+			self.CHUNK = get('chunk', conf.getint) or self.CHUNK
+			self.PERIOD = get('period', conf.getfloat) or self.PERIOD
+			self.FULLSCALE = get('fullscale', conf.getint) or self.FULLSCALE
+			if conf.has_option('synthetic', 'realtime'):
+				self.REALTIME = conf.getboolean('synthetic', 'realtime')
+			if conf.has_option('synthetic', 'seed'):
+				self.SEED = conf.getint('synthetic', 'seed')
+			for c in range(self.CHANNELS):
+				signal = get('ch%d' % (c + 1), conf.get)
+				if signal is not None:
+					if c < len(self.signals):
+						self.signals[c] = signal.strip("\"'")
+					else:
+						self.signals.append(signal.strip("\"'"))
+		self.MAX_RATE = self.RATE
+		self.setup()
+
+	def setup(self):
+		"""Precompute one period of every channel."""
+		rs = np.random.RandomState(self.SEED)
+		length = max(int(self.PERIOD*self.RATE), self.CHUNK)
+		self.table = np.empty((self.CHANNELS, length), dtype=self.DTYPE)
+		for c in range(self.CHANNELS):
+			signal = self.signals[c % len(self.signals)]
+			x = generate(parse_signal(signal), self.RATE, length, rs)
+			np.clip(x*self.FULLSCALE, np.iinfo(self.DTYPE).min,
+			        np.iinfo(self.DTYPE).max, out=x)
+			self.table[c] = x
+		self._position = 0
+		self._start_time = time.time()
+
+	def read_into(self, buffers, npoints=None, verbose=False):
+		if npoints is None:
+			npoints = len(buffers[0])
+		if self.REALTIME:
+			delay = (self._position + npoints)/float(self.RATE) - \
+			        (time.time() - self._start_time)
+			if delay > 0:
+				time.sleep(delay)
+		length = self.table.shape[1]
+		i = 0
+		while i < npoints:
+			start = (self._position + i) % length
+			n = min(npoints - i, length - start)
+			for c in range(self.CHANNELS):
+				buffers[c][i:i+n] = self.table[c, start:start+n]
+			i += n
+		self._position += npoints
+		return npoints
+
+	def close(self):
+		self.table = None
@@ -0,0 +1,233 @@
+"""
+Pure-Python network probe, reading framed binary sample blocks over TCP.
+
+No C library is needed: the probe talks to any server implementing the
+small protocol below, for example the simulator in this module, which can
+be started with:
+
+	python -m dualscope123.probes.tcp [port [rate [channels]]]
+
+Protocol, all integers little-endian:
+
+ * on connection, the server sends a HELLO: magic 'DS12', protocol
+   version, number of channels and sample rate.
+ * the client sends REQUESTs: magic 'DSRQ', sequence number and number
+   of samples per channel.
+ * the server replies to every request, in order, with a BLOCK header:
+   magic 'DSBK', sequence number, number of samples per channel and
+   number of channels, followed by the int32 samples, one channel
+   after the other.
+
+Consecutive blocks are consecutive in time. The probe keeps several
+requests outstanding, so that the server never waits for the client.
+
+Configuration, in ~/.dualscope123:
+
+	[tcp]
+	hostname = localhost
+	port = 5123
+	chunk = 4096      ; samples per channel per block
+	pipeline = 4      ; outstanding requests
+"""
+from .generic import GenericProbe
+import os.path, ConfigParser
+import socket, SocketServer
+import struct, sys, time
+import numpy as np
+
+PROTOCOL_VERSION = 1
+HELLO = struct.Struct('<4sHHI')     # magic, version, channels, rate
+REQUEST = struct.Struct('<4sII')    # magic, sequence number, samples
+BLOCK = struct.Struct('<4sIIHH')    # magic, sequence number, samples, channels, 0
+HELLO_MAGIC, REQUEST_MAGIC, BLOCK_MAGIC = 'DS12', 'DSRQ', 'DSBK'
+
+DEFAULT_PORT = 5123
+
+class Probe(GenericProbe):
+	API_VERSION = 2   # read_into(), DTYPE, MAX_RATE
+
+	def __init__(self):
+		# the rate and channel count are sent by the server on open()
+		self.CHUNK = 4096   # samples per channel per block
+		self.FORMAT = int
+		self.DTYPE = np.int32
+		self.CHANNELS = None
+		self.RATE = None
+		self.MAX_RATE = None
+		self.HOSTNAME = 'localhost'
+		self.PORT = DEFAULT_PORT
+		self.PIPELINE = 4
+		self.sock = None
+		self._sent = 0       # requests sent
+		self._received = 0   # blocks received
+		self._leftover = None
+
+	def open(self):
+		conf_path = os.path.expanduser('~/.dualscope123')
+		conf = ConfigParser.ConfigParser()
+		conf.read([conf_path])
+		if 'tcp' in conf.sections():
+			if conf.has_option('tcp', 'hostname'):
+				self.HOSTNAME = conf.get('tcp', 'hostname').strip("\"'")
+			if conf.has_option('tcp', 'port'):
+				self.PORT = conf.getint('tcp', 'port')
+			if conf.has_option('tcp', 'chunk'):
+				self.CHUNK = conf.getint('tcp', 'chunk')
+			if conf.has_option('tcp', 'pipeline'):
+				self.PIPELINE = max(1, conf.getint('tcp', 'pipeline'))
+		self.sock = socket.create_connection((self.HOSTNAME, self.PORT))
+		self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+		magic, version, self.CHANNELS, self.RATE = \
+			HELLO.unpack(self._recv(HELLO.size))
+		if magic != HELLO_MAGIC or version != PROTOCOL_VERSION:
+			raise IOError("%s:%d is not a dualscope123 server (protocol %d)." %
+			              (self.HOSTNAME, self.PORT, PROTOCOL_VERSION))
+		self.MAX_RATE = self.RATE
+		self._sent = self._received = 0
+		self._leftover = None
+
+	def read_into(self, buffers, npoints=None, verbose=False):
+		"""Read the next 'npoints' samples of every channel into 'buffers'.
+
+		Full blocks are received directly into the buffers, if their rows
+		are C-contiguous int32 arrays.
+
+		Returns the number of samples read per channel.
+		"""
+		if npoints is None:
+			npoints = len(buffers[0])
+		i = 0
+		if self._leftover is not None:
+			n = min(npoints, self._leftover.shape[1])
+			for c in range(self.CHANNELS):
+				buffers[c][:n] = self._leftover[c, :n]
+			self._leftover = self._leftover[:, n:] if \
+			                 n < self._leftover.shape[1] else None
+			i = n
+		while i < npoints:
+			# keep the pipeline full
+			while self._sent - self._received < self.PIPELINE:
+				self.sock.sendall(REQUEST.pack(REQUEST_MAGIC, self._sent,
+				                               self.CHUNK))
+				self._sent += 1
+			n = min(self.CHUNK, npoints - i)
+			rows = [buffers[c][i:i+n] for c in range(self.CHANNELS)]
+			if n == self.CHUNK and all([isinstance(r, np.ndarray) and
+			                            r.dtype == self.DTYPE and
+			                            r.flags.c_contiguous for r in rows]):
+				self._recv_block(rows)
+			else:
+				block = np.empty((self.CHANNELS, self.CHUNK), dtype=self.DTYPE)
+				self._recv_block(block)
+				for c in range(self.CHANNELS):
+					rows[c][:] = block[c, :n]
+				self._leftover = block[:, n:]
+			i += n
+		if verbose:
+			print "tcp: read %d samples, %d requests outstanding" % \
+			      (npoints, self._sent - self._received)
+		return npoints
+
+	def _recv_block(self, rows):
+		magic, seq, nsamples, channels, _ = \
+			BLOCK.unpack(self._recv(BLOCK.size))
+		if magic != BLOCK_MAGIC or seq != self._received % 2**32 or \
+		   nsamples != self.CHUNK or channels != self.CHANNELS:
+			raise IOError("tcp: unexpected block %d (%d samples, %d channels)." %
+			              (seq, nsamples, channels))
+		for row in rows:
+			self._recv_into(row)
+		self._received += 1
+
+	def _recv(self, nbytes):
+		data = np.empty((nbytes,), dtype=np.uint8)
+		self._recv_into(data)
+		return data.tostring()
+
+	def _recv_into(self, array):
+		view = memoryview(array.view(np.uint8))
+		nbytes = array.nbytes
+		i = 0
+		while i < nbytes:
+			n = self.sock.recv_into(view[i:], nbytes - i)
+			if not n:
+				raise IOError("tcp: connection closed by %s:%d." %
+				              (self.HOSTNAME, self.PORT))
+			i += n
+
+	def close(self):
+		if self.sock is not None:
+			self.sock.close()
+			self.sock = None
+
+class SimulatorHandler(SocketServer.BaseRequestHandler):
+	"""Serves a continuous multi-tone test signal to one client."""
+	def handle(self):
+		try:
+			self._serve()
+		except socket.error:
+			# the client went away
+			pass
+
+	def _serve(self):
+		server = self.server
+		self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+		self.request.sendall(HELLO.pack(HELLO_MAGIC, PROTOCOL_VERSION,
+		                                server.channels, server.rate))
+		position = 0
+		start_time = time.time()
+		while True:
+			request = ''
+			while len(request) < REQUEST.size:
+				data = self.request.recv(REQUEST.size - len(request))
+				if not data:
+					return
+				request += data
+			magic, seq, nsamples = REQUEST.unpack(request)
+			if magic != REQUEST_MAGIC:
+				return
+			if server.realtime:
+				# do not serve samples before they would be acquired
+				delay = (position + nsamples)/float(server.rate) - \
+				        (time.time() - start_time)
+				if delay > 0:
+					time.sleep(delay)
+			index = np.arange(position, position + nsamples) % server.table.shape[1]
+			position += nsamples
+			self.request.sendall(BLOCK.pack(BLOCK_MAGIC, seq, nsamples,
+			                                server.channels, 0) +
+			                     server.table[:, index].tostring())
+
+class Simulator(SocketServer.ThreadingTCPServer):
+	"""A local stand-in for a network ADC, implementing the protocol above.
+
+	Channel c carries a sine at (c + 1) kHz plus some noise. With realtime
+	set, the samples are served at the nominal rate, otherwise as fast as
+	the client asks for them.
+	"""
+	allow_reuse_address = True
+	daemon_threads = True
+
+	def __init__(self, address=('localhost', DEFAULT_PORT), rate=1000000,
+	             channels=2, realtime=False):
+		SocketServer.ThreadingTCPServer.__init__(self, address, SimulatorHandler)
+		self.rate = rate
+		self.channels = channels
+		self.realtime = realtime
+		# one second of signal, precomputed: integer frequencies make it
+		# periodic
+		t = np.arange(rate)/float(rate)
+		table = np.empty((channels, rate), dtype='<i4')
+		for c in range(channels):
+			table[c] = 2**20*np.sin(2*np.pi*1000.0*(c + 1)*t) + \
+			           2**10*np.random.randn(rate)
+		self.table = table
+
+if __name__ == '__main__':
+	args = [int(a) for a in sys.argv[1:]]
+	port = args[0] if len(args) > 0 else DEFAULT_PORT
+	rate = args[1] if len(args) > 1 else 1000000
+	channels = args[2] if len(args) > 2 else 2
+	server = Simulator(('', port), rate, channels, realtime=True)
+	print "Simulating %d channels at %d S/s on port %d." % (channels, rate, port)
+	server.serve_forever()
@@ -0,0 +1,423 @@
+"""
+Power spectral density of windowed frames.
+
+The window, its normalisation and the frequency axis only depend on the
+frame length and the window type: PSD computes them once and reuses them
+until either changes, or invalidate() is called.
+
+All the channels of a frame go through a single real-input FFT, which
+only computes the non-negative frequencies, zero-padded by default to the
+next length with no prime factor other than 2, 3 and 5.
+
+Welch is an Acquisition sink estimating the PSD with Welch's method: the
+stream is cut in overlapping windowed segments as it is acquired, and the
+periodograms of the last 'segments' segments are averaged. All the
+segments completed by a block are transformed in one batched FFT.
+
+Zoom computes the PSD of a band [lo, hi] only, zoom FFT style: the band
+is mixed down to 0 Hz, low-pass filtered and decimated, and the complex
+baseband is transformed. The mixing is folded into the filter taps and
+the filter is only evaluated at the decimated samples: the cost is a few
+multiplications per input sample plus a short FFT, while the bins are as
+narrow as those of a full FFT of the whole input.
+
+The FFTs are computed by a backend from fftbackends, numpy.fft by default.
+"""
+import threading
+
+import numpy as np
+from numpy.lib.stride_tricks import as_strided
+
+from . import averaging, fftbackends
+
+WINDOWS = {'blackman': np.blackman,
+           'hanning': np.hanning,
+           'hamming': np.hamming,
+           'bartlett': np.bartlett,
+           'rectangular': np.ones}
+DEFAULT_WINDOW = 'blackman'
+# Welch estimator defaults
+DEFAULT_SEGMENT = 4096       # samples per segment
+DEFAULT_OVERLAP = 0.5        # fraction of a segment
+DEFAULT_SEGMENTS = 16        # segments averaged
+# zoom FFT defaults
+DEFAULT_ZOOM_POINTS = 1024   # samples after decimation, i.e. bins
+ZOOM_ORDER = 16              # filter taps per decimated sample
+
+def fast_length(n):
+    """Return the smallest 2**a * 3**b * 5**c >= n, a fast FFT length."""
+    best = 2**int(np.ceil(np.log2(n)))
+    p5 = 1
+    while p5 < best:
+        p35 = p5
+        while p35 < best:
+            p = p35
+            while p < n:
+                p *= 2
+            best = min(best, p)
+            p35 *= 3
+        p5 *= 5
+    return best
+
+class PSD(object):
+    def __init__(self, rate, window=DEFAULT_WINDOW, pad=True, backend=None):
+        if window not in WINDOWS:
+            raise ValueError("Unknown window '%s'." % (window,))
+        if backend is None:
+            backend = fftbackends.get(fftbackends.DEFAULT_BACKEND)
+        self.backend = backend   # computes the FFTs, see fftbackends
+        self.rate = rate
+        self.window_type = window
+        self.pad = pad           # zero-pad to a fast FFT length
+        self.size = None
+        self.nfft = None         # FFT length
+        self.window = None       # the window samples
+        self.norm = None         # scales |FFT|^2 to a PSD
+        self.f = None            # frequency axis, 0 to rate/2
+        self.df = None           # bin width
+        self._windowed = None    # scratch, the windowed frame
+
+    def invalidate(self):
+        self.size = None
+
+    def setWindow(self, window):
+        if window not in WINDOWS:
+            raise ValueError("Unknown window '%s'." % (window,))
+        self.window_type = window
+        self.invalidate()
+
+    def setup(self, size):
+        """Compute the window, normalisation and axis for frames of size
+        samples, unless they are cached already."""
+        if size == self.size:
+            return
+        self.window = WINDOWS[self.window_type](size)
+        sumw = np.sum(self.window*self.window)
+        sumw *= 2.0          # sym about Nyquist (*4); use rms (/2)
+        sumw *= self.rate
+        self.norm = 1.0/sumw
+        self.nfft = fast_length(size) if self.pad else size
+        self.df = float(self.rate)/self.nfft
+        self.f = np.arange(self.nfft//2 + 1)*self.df
+        self.size = size
+
+    def __call__(self, data):
+        """One-sided PSD of the (channels, size) frame data, along the last
+        axis. Returns a (channels, nfft/2 + 1) array. data may have more
+        leading dimensions, e.g. (segments, channels, size)."""
+        self.setup(data.shape[-1])
+        if self._windowed is None or self._windowed.shape != data.shape:
+            self._windowed = np.empty(data.shape)
+        np.multiply(data, self.window, out=self._windowed)
+        A = self.backend.rfft(self._windowed, self.nfft)
+        B = A.real*A.real
+        B += A.imag*A.imag
+        B *= self.norm
+        return B
+
+class Welch(object):
+    def __init__(self, acquisition, rate, segment=DEFAULT_SEGMENT,
+                 overlap=DEFAULT_OVERLAP, window=DEFAULT_WINDOW,
+                 segments=DEFAULT_SEGMENTS, backend=None):
+        self.acquisition = acquisition
+        # the backend is used from the acquisition thread only, it should
+        # be a realtime one, see fftbackends.get()
+        self.psd = PSD(rate, window, backend=backend)
+        self.averager = averaging.Averager(averaging.BOXCAR, segments)
+        self.enabled = False
+        self.segment = 0         # samples per segment
+        self.hop = 0             # samples between segment starts
+        self.segments = 0        # segments averaged
+        self.count = 0L          # segments transformed so far
+        self.lost = 0            # times the segments were overwritten
+        self._next = None        # stream position of the next segment
+        self._scratch = None     # the samples of the newest segments
+        self._pending = False
+        self._lock = threading.Lock()
+        self.configure(segment, overlap, segments)
+        self.enabled = False
+
+    def configure(self, segment=None, overlap=None, segments=None):
+        """Change the settings and enable the estimator. None keeps the
+        current value. Restarts the average."""
+        with self._lock:
+            if segment is not None:
+                self.segment = max(int(segment), 2)
+            if overlap is not None:
+                overlap = min(max(float(overlap), 0.), 0.95)
+                self.hop = max(int(round(self.segment*(1. - overlap))), 1)
+            if segments is not None:
+                self.segments = max(int(segments), 1)
+            # drop every segment of the previous run, reallocating
+            self.averager.setMode(averaging.BOXCAR, self.segments)
+            self._next = None
+            self._scratch = None
+            self._pending = False
+            self.enabled = True
+
+    def disable(self):
+        with self._lock:
+            self.enabled = False
+
+    def __call__(self, block):
+        """Transform the segments completed by a (channels, n) block, see
+        Acquisition.add_sink()."""
+        with self._lock:
+            if not self.enabled:
+                return
+            written = self.acquisition.written
+            if self._next is None:
+                self._next = written - block.shape[1]
+            k = (written - self._next - self.segment)//self.hop + 1
+            if k <= 0:
+                return
+            if k > self.segments:
+                # only the newest segments are in the average
+                self._next += (k - self.segments)*self.hop
+                k = self.segments
+            span = self.segment + (k - 1)*self.hop
+            if self._scratch is None:
+                self._scratch = np.empty((block.shape[0], self.segment +
+                                          (self.segments - 1)*self.hop),
+                                         dtype=block.dtype)
+            X = self.acquisition.read_at(self._next, span,
+                                         self._scratch[:, :span])
+            if X is None:
+                # overwritten, restart from the newest samples
+                self.lost += 1
+                self._next = written - self.segment
+                return
+            # the k overlapping segments, as a (k, channels, segment) view
+            frames = as_strided(X, (k, X.shape[0], self.segment),
+                                (self.hop*X.strides[1], X.strides[0],
+                                 X.strides[1]))
+            for B in self.psd(frames):
+                self.averager.add(B)
+            self._next += k*self.hop
+            self.count += k
+            self._pending = True
+
+    def fetch(self):
+        """Return the (channels, nfft/2 + 1) average of the last segments
+        if segments were added since the last call, or None. The frequency
+        axis is self.psd.f."""
+        with self._lock:
+            if not self._pending:
+                return None
+            self._pending = False
+            return self.averager.mean.copy()
+
+class Zoom(object):
+    def __init__(self, rate, window=DEFAULT_WINDOW, backend=None,
+                 order=ZOOM_ORDER):
+        if window not in WINDOWS:
+            raise ValueError("Unknown window '%s'." % (window,))
+        if backend is None:
+            backend = fftbackends.get(fftbackends.DEFAULT_BACKEND)
+        self.backend = backend
+        self.rate = rate
+        self.window_type = window
+        self.order = order
+        self.key = None          # (points, lo, hi, maxlength) of setup()
+        self.decimation = None   # input samples per output sample
+        self.points = None       # samples after decimation
+        self.length = None       # input samples needed
+        self.nfft = None
+        self.f = None            # frequency axis, around the band centre
+        self.df = None
+        self._taps = None        # (real, imag) polyphase mixing filter
+        self._mix = None         # mixing phase at the decimated samples
+        self._x = None           # scratch, the input as floats
+
+    def setup(self, points, lo, hi, maxlength=None):
+        """Prepare the transform of the band [lo, hi] Hz to points bins, from
+        at most maxlength input samples. Returns the input length needed,
+        self.length. Cached while the arguments do not change."""
+        key = (points, lo, hi, maxlength)
+        if key == self.key:
+            return self.length
+        order = self.order
+        centre = 0.5*(lo + hi)
+        # a complex baseband sampled at twice the bandwidth, so that the
+        # transition band of the filter stays out of the band
+        decimation = max(int(self.rate/(2.*max(hi - lo, 1e-9))), 1)
+        if maxlength is not None:
+            # as much zoom as the input available allows
+            decimation = max(min(decimation, maxlength//(points + order - 1)),
+                             1)
+            points = max(min(points, maxlength//decimation - order + 1), 2)
+        taps = order*decimation
+        k = np.arange(taps)
+        if decimation > 1:
+            # windowed sinc low-pass, cut off at the decimated Nyquist
+            h = np.sinc((k - (taps - 1)/2.)/decimation)*np.blackman(taps)
+        else:
+            h = np.zeros(taps)
+            h[taps//2] = 1.
+        h /= h.sum()
+        # mixing by exp(-2j pi centre t), folded into the taps
+        g = h*np.exp(-2j*np.pi*centre/self.rate*k)
+        g = g.reshape(order, decimation)
+        self._taps = (g.real.copy(), g.imag.copy())
+        # and the window, applied with the mixing at the decimated samples
+        window = WINDOWS[self.window_type](points)
+        self._mix = np.exp(-2j*np.pi*centre/self.rate*decimation*
+                           np.arange(points))*window
+        rate = float(self.rate)/decimation
+        self.norm = 1.0/(2.0*np.sum(window*window)*rate)
+        self.nfft = fast_length(points)
+        self.df = rate/self.nfft
+        self.f = centre + (np.arange(self.nfft) - self.nfft//2)*self.df
+        self.decimation = decimation
+        self.points = points
+        self.length = (points + order - 1)*decimation
+        self._x = None
+        self.key = key
+        return self.length
+
+    def __call__(self, data):
+        """PSD of the band, from the last self.length samples of the
+        (channels, n) data. Returns a (channels, nfft) array, on self.f."""
+        channels = data.shape[0]
+        if self._x is None or self._x.shape[0] != channels:
+            self._x = np.empty((channels, self.length))
+        self._x[...] = data[:, -self.length:]
+        blocks = self._x.reshape(channels, -1, self.decimation)
+        n = self.points
+        real, imag = self._taps
+        y = np.zeros((channels, n), dtype=np.complex128)
+        for c in range(channels):
+            yr, yi = y[c].real, y[c].imag
+            for q in range(self.order):
+                # (n, decimation) contiguous: matrix-vector products
+                blk = blocks[c, q:q+n]
+                yr += np.dot(blk, real[q])
+                yi += np.dot(blk, imag[q])
+        y *= self._mix
+        A = self.backend.fft(y, self.nfft)
+        B = A.real*A.real
+        B += A.imag*A.imag
+        B *= self.norm
+        return np.fft.fftshift(B, axes=-1)
+
+def test_psd():
+    rate = 1000.
+    t = np.arange(1000)/rate
+    x = np.vstack((np.sin(2*np.pi*100*t), 0.5*np.sin(2*np.pi*200*t)))
+    psd = PSD(rate, pad=False)
+    B = psd(x)
+    assert B.shape == (2, 501)
+    assert np.argmax(B[0]) == 100 and np.argmax(B[1]) == 200
+    # same normalisation as before: blackman, 2*sum(w^2)*rate
+    w = np.blackman(1000)
+    A = np.fft.fft(x[0]*w)
+    assert np.allclose(B[0], (A*A.conjugate()).real[:501]/(2*np.sum(w*w)*rate))
+    # padded: 1000 is 2**3*5**3 already, 1001 = 7*11*13 is not
+    psd = PSD(rate)
+    assert psd(x).shape == (2, 501)
+    assert psd(x[:, :999]).shape == (2, 501) and psd.nfft == 1000
+    B = psd(np.hstack((x, x[:, :1])))
+    assert psd.nfft == 1024 and B.shape == (2, 513)
+    assert abs(psd.f[np.argmax(B[0])] - 100) < psd.df
+    # cached while the frame length does not change
+    psd(x)
+    window = psd.window
+    psd(x)
+    assert psd.window is window
+
+def test_fast_length():
+    for n, m in ((1, 1), (7, 8), (1000, 1000), (1001, 1024), (4097, 4320),
+                 (88200, 90000)):
+        assert fast_length(n) == m, (n, fast_length(n))
+
+def test_welch():
+    class Stream(object):
+        written = 0L
+        def read_at(self, start, n, out=None):
+            if out is None:
+                out = np.empty((2, n))
+            out[:] = self.data[:, start:start+n]
+            return out
+    rate = 1000.
+    stream = Stream()
+    stream.data = np.random.randn(2, 20000)
+    welch = Welch(stream, rate, segment=256, overlap=0.5, segments=1000)
+    assert welch(stream.data[:, :10]) is None and welch.count == 0
+    welch.configure()
+    # odd-sized blocks: segments straddle them
+    for i in range(0, 20000, 333):
+        block = stream.data[:, i:i+333]
+        stream.written += block.shape[1]
+        welch(block)
+    B = welch.fetch()
+    assert welch.fetch() is None
+    # segments at 0, 128, ... up to 20000 - 256
+    assert welch.count == (20000 - 256)//128 + 1
+    assert B.shape == (2, 129)
+    # same as averaging the periodograms of every segment
+    psd = PSD(rate)
+    starts = np.arange(welch.count)*128
+    expected = np.mean([psd(stream.data[:, s:s+256]) for s in starts], axis=0)
+    assert np.allclose(B, expected)
+    # white noise of unit variance: flat at 1/(2*rate) with the scaling
+    # above, with a low variance
+    assert abs(np.mean(B[:, 1:-1])*2*rate - 1) < 0.05
+    assert np.std(B[:, 1:-1])*2*rate < 0.2
+    # only the newest segments are averaged
+    welch.configure(segments=4)
+    stream.written = 0L
+    for i in range(0, 20000, 1000):
+        block = stream.data[:, i:i+1000]
+        stream.written += block.shape[1]
+        welch(block)
+    last = (20000 - 256)//128*128
+    expected = np.mean([psd(stream.data[:, s:s+256])
+                        for s in range(last - 3*128, last + 1, 128)], axis=0)
+    assert np.allclose(welch.fetch(), expected)
+    # switched off and on again: only the new segments are averaged
+    welch.disable()
+    welch.configure()
+    stream.data = np.zeros((2, 20000))
+    stream.written = 0L
+    for i in range(0, 2000, 500):
+        block = stream.data[:, i:i+500]
+        stream.written += block.shape[1]
+        welch(block)
+    assert np.all(welch.fetch() == 0)
+
+def test_zoom():
+    rate = 8000.
+    t = np.arange(40000)/rate
+    x = np.vstack((np.sin(2*np.pi*1002.3*t) + 1e-3*np.sin(2*np.pi*1010*t),
+                   # 2000 Hz from the centre, it would alias onto it
+                   1e-3*np.sin(2*np.pi*1050*t) + np.sin(2*np.pi*3000*t)))
+    zoom = Zoom(rate)
+    length = zoom.setup(512, 900., 1100.)
+    assert zoom.decimation == 20 and length == (512 + 15)*20
+    assert zoom.setup(512, 900., 1100.) == length
+    B = zoom(x)
+    assert B.shape == (2, 512) and len(zoom.f) == 512
+    assert zoom.df < 1.
+    # resolved: 1002.3 Hz and 1010 Hz, 60 dB lower
+    assert abs(zoom.f[np.argmax(B[0])] - 1002.3) < zoom.df
+    weak = (zoom.f > 1008) & (zoom.f < 1012)
+    assert abs(zoom.f[weak][np.argmax(B[0][weak])] - 1010) < zoom.df
+    # the out of band tone is rejected, below the -60 dB one
+    assert abs(zoom.f[np.argmax(B[1])] - 1050) < zoom.df
+    assert np.max(B[1]) > 10*np.max(B[1][np.abs(zoom.f - 1000.) < 2])
+    # the same density as the full PSD, for white noise
+    noise = np.random.randn(1, 100000)
+    zoom.setup(512, 900., 1100.)
+    levels = [np.mean(zoom(noise[:, i:i+length]))
+              for i in range(0, 100000 - length, length)]
+    assert abs(np.mean(levels)*2*rate - 1) < 0.15, np.mean(levels)*2*rate
+    # limited by the input available
+    zoom.setup(512, 900., 1100., maxlength=5000)
+    assert zoom.length <= 5000 and zoom.decimation == 9
+    assert zoom(x).shape[1] == zoom.nfft
+
+if __name__ == '__main__':
+    test_fast_length()
+    test_psd()
+    test_welch()
+    test_zoom()
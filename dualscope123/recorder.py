@@ -0,0 +1,214 @@
+"""
+Continuous recording of the acquired samples to disk.
+
+Recordings are raw binary files with a fixed-size text header:
+
+    DUALSCOPE123 RECORDING 1
+    rate = 44100
+    channels = 2
+    dtype = <i2
+    start_time = 1414141414.125
+    samples = 441000
+    gaps = 0
+
+padded to HEADER_SIZE bytes and followed by the samples, frame after
+frame: sample 0 of every channel, then sample 1, ... They can be memory
+mapped with load().
+
+The Recorder is fed blocks by the acquisition thread and writes them from
+a background thread of its own. Its queue is bounded: if the disk cannot
+keep up, blocks are dropped and counted, instead of growing the memory
+usage or stalling the acquisition. The samples of a recording are then
+not contiguous: every gap is logged, as it happens, in a text file next
+to the recording, <path>.gaps, one 'position length' line per gap, where
+position is the number of samples in the file before the gap and length
+the number of samples dropped. load() returns them, and the replay probe
+replays the gaps as zeros, so that the recording keeps its time base.
+"""
+import os.path
+import Queue
+import threading
+import time
+
+import numpy as np
+
+MAGIC = 'DUALSCOPE123 RECORDING 1'
+HEADER_SIZE = 1024
+# maximum amount of data waiting to be written, in bytes
+DEFAULT_MAX_QUEUED = 64*2**20
+
+def _header(meta):
+    lines = [MAGIC] + ['%s = %s' % (key, meta[key]) for key in
+                       ('rate', 'channels', 'dtype', 'start_time', 'samples',
+                        'gaps')]
+    header = '\n'.join(lines) + '\n'
+    return header + ' '*(HEADER_SIZE - len(header) - 1) + '\n'
+
+def read_header(path):
+    """Return the metadata of a recording, as a dictionary."""
+    with open(path, 'rb') as fp:
+        header = fp.read(HEADER_SIZE)
+    lines = header.split('\n')
+    if lines[0] != MAGIC:
+        raise IOError("%s is not a dualscope123 recording." % (path,))
+    meta = {}
+    for line in lines[1:]:
+        if '=' in line:
+            key, value = [x.strip() for x in line.split('=', 1)]
+            meta[key] = value
+    return {'rate': int(meta['rate']),
+            'channels': int(meta['channels']),
+            'dtype': np.dtype(meta['dtype']),
+            'start_time': float(meta['start_time']),
+            'samples': long(meta['samples']),
+            'gaps': int(meta.get('gaps', 0))}
+
+def gaps_path(path):
+    return path + '.gaps'
+
+def read_gaps(path):
+    """Return the gaps of a recording as a (gaps, 2) array of (position,
+    length) rows, in samples, see the module documentation."""
+    gaps = np.zeros((0, 2), dtype=np.int64)
+    if os.path.exists(gaps_path(path)):
+        with open(gaps_path(path)) as fp:
+            rows = [[long(x) for x in line.split()] for line in fp
+                    if line.strip()]
+        if rows:
+            gaps = np.array(rows, dtype=np.int64).reshape(-1, 2)
+    return gaps
+
+def load(path):
+    """Memory map a recording.
+
+    Returns the (samples, channels) read-only memmap and the metadata.
+    The number of samples is inferred from the file size, so that
+    recordings which were not stopped cleanly can be loaded too. The
+    samples dropped while recording are not in the memmap: meta['gaps'] is
+    the (gaps, 2) array of read_gaps().
+    """
+    meta = read_header(path)
+    meta['gaps'] = read_gaps(path)
+    framesize = meta['channels']*meta['dtype'].itemsize
+    meta['samples'] = (os.path.getsize(path) - HEADER_SIZE)//framesize
+    if not meta['samples']:
+        return np.zeros((0, meta['channels']), dtype=meta['dtype']), meta
+    data = np.memmap(path, dtype=meta['dtype'], mode='r', offset=HEADER_SIZE,
+                     shape=(meta['samples'], meta['channels']))
+    return data, meta
+
+class Recorder(object):
+    """Stream (channels, n) blocks to a recording, from a writer thread."""
+    def __init__(self, path, rate, channels, dtype,
+                 max_queued=DEFAULT_MAX_QUEUED):
+        self.path = path
+        self.meta = {'rate': rate, 'channels': channels,
+                     'dtype': np.dtype(dtype).str, 'start_time': 0.0,
+                     'samples': 0, 'gaps': 0}
+        self.samples = 0L    # samples per channel written
+        self.dropped = 0L    # samples per channel lost to a full queue
+        self.gaps = 0        # runs of dropped samples
+        self._gap = 0L       # samples dropped since the last block queued
+        self._queued = 0     # bytes waiting in the queue
+        self._lock = threading.Lock()
+        self._max_queued = max_queued
+        self._queue = Queue.Queue()
+        self._thread = None
+        self._fp = None
+        self._gapsfp = None
+
+    def start(self):
+        self.meta['start_time'] = '%.6f' % time.time()
+        self._fp = open(self.path, 'wb')
+        self._fp.write(_header(self.meta))
+        self._thread = threading.Thread(target=self._run,
+                                        name='dualscope123-recorder')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def write(self, block):
+        """Queue a copy of a (channels, n) block, interleaving it.
+
+        Called from the acquisition thread, never blocks.
+        """
+        frames = np.array(block.T, dtype=self.meta['dtype'], order='C')
+        with self._lock:
+            if self._queued + frames.nbytes > self._max_queued:
+                self.dropped += frames.shape[0]
+                self._gap += frames.shape[0]
+                return
+            self._queued += frames.nbytes
+            gap, self._gap = self._gap, 0L
+        if gap:
+            # logged by the writer thread, which knows the file position
+            self._queue.put(gap)
+        self._queue.put(frames)
+
+    def _logGap(self, length):
+        if self._gapsfp is None:
+            self._gapsfp = open(gaps_path(self.path), 'w')
+        self._gapsfp.write('%d %d\n' % (self.samples, length))
+        self._gapsfp.flush()
+        self.gaps += 1
+
+    def _run(self):
+        while True:
+            frames = self._queue.get()
+            if frames is None:
+                break
+            if not isinstance(frames, np.ndarray):
+                self._logGap(frames)
+                continue
+            frames.tofile(self._fp)
+            self.samples += frames.shape[0]
+            with self._lock:
+                self._queued -= frames.nbytes
+
+    def stop(self):
+        """Write the queued blocks, then finalize the header."""
+        self._queue.put(None)
+        self._thread.join()
+        if self._gap:
+            # dropped at the end
+            self._logGap(self._gap)
+            self._gap = 0L
+        if self._gapsfp is not None:
+            self._gapsfp.close()
+        self.meta['samples'] = self.samples
+        self.meta['gaps'] = self.gaps
+        self._fp.seek(0)
+        self._fp.write(_header(self.meta))
+        self._fp.close()
+        if self.dropped:
+            print "(WW) Recorder: %d samples could not be written to %s, " \
+                  "%d gaps logged in %s." % (self.dropped, self.path,
+                                            self.gaps, gaps_path(self.path))
+
+def test_gaps():
+    import tempfile
+    path = tempfile.mktemp('.dsr')
+    x = np.arange(10000, dtype=np.int16).reshape(2, 5000)
+    blocks = [x[:, i:i+500] for i in range(0, 5000, 500)]
+    # 2000 bytes per block: two blocks fit in the queue
+    rec = Recorder(path, 1000, 2, np.int16, max_queued=4000)
+    # the writer is not started yet: the third and fourth blocks are dropped
+    for block in blocks[:4]:
+        rec.write(block)
+    rec.start()
+    for block in blocks[4:]:
+        while rec._queued:
+            time.sleep(.01)
+        rec.write(block)
+    rec.stop()
+    data, meta = load(path)
+    assert rec.dropped == 1000 and len(data) == 4000
+    assert meta['gaps'].tolist() == [[1000, 1000]]
+    assert read_header(path)['gaps'] == 1
+    # the file and the gaps rebuild the time base
+    assert np.all(data[:1000] == x[:, :1000].T)
+    assert np.all(data[1000:] == x[:, 2000:].T)
+    os.remove(path)
+    os.remove(gaps_path(path))
+
+if __name__ == '__main__':
+    test_gaps()
@@ -0,0 +1,345 @@
+"""
+Streaming trigger engine.
+
+The Trigger is an Acquisition sink: it scans every acquired block of the
+trigger channel as it arrives, so no sample is scanned twice and crossings
+on block boundaries are found like any other. The arming state is carried
+from one block to the next.
+
+Hysteresis: on a rising slope the trigger only fires at a crossing of the
+level if the signal went below level - hysteresis since the last crossing,
+and symmetrically on a falling slope, so that noise around the level does
+not retrigger. Holdoff: no trigger fires within holdoff samples of the
+previous one.
+
+Trigger points are estimated between samples, interpolating linearly
+across the threshold crossing, and frame() resamples the frames so that
+the trigger point always falls at the same fractional position: averaged
+frames are not smeared by the +/- half sample jitter of the sampling
+clock against the signal.
+
+frame() returns the newest complete triggered frame, read from the
+acquisition ring buffer: pretrigger samples before the trigger point and
+the rest after it.
+
+For burst capture, a Segments object set as the trigger capture receives
+every trigger and copies the frames, from the acquisition thread, into
+one preallocated (count, channels, length) array, until it is full.
+"""
+import collections
+import threading
+
+import numpy as np
+
+from . import csvlib, utils
+
+# slopes, as in the Scope trigger combo box
+BOTH, RISING, FALLING = 0, 1, 2
+# lobes of the Lanczos kernel aligning the frames, see utils.fractional_shift
+LOBES = 4
+
+class Trigger(object):
+    def __init__(self, acquisition, maxpending=64):
+        self.acquisition = acquisition
+        self.channel = None      # index of the trigger channel, None is off
+        self.level = 0.0
+        self.slope = RISING
+        self.hysteresis = 0.0
+        self.holdoff = 0         # samples
+        self.length = 0          # samples per frame
+        self.pretrigger = 0      # samples before the trigger point
+        self.count = 0L          # triggers found so far
+        self.interpolate = True  # sub-sample trigger points and alignment
+        # absolute positions of the latest triggers, newest last, in
+        # fractional samples
+        self.triggers = collections.deque(maxlen=maxpending)
+        self._state = 0          # -1 below, +1 above the band, 0 unknown
+        self._last = None        # last sample of the previous block
+        self._next = 0L          # first sample allowed to trigger (holdoff)
+        self._shown = None       # position of the last frame returned
+        self.capture = None      # Segments being filled, if any
+        self._lock = threading.Lock()
+
+    def configure(self, channel, level, slope=RISING, hysteresis=0.0,
+                  holdoff=0, length=None, pretrigger=None):
+        """Change the settings; resets the state if channel or slope change.
+
+        Called from the GUI thread while the acquisition thread feeds
+        blocks.
+        """
+        with self._lock:
+            if channel != self.channel or slope != self.slope:
+                self._state = 0
+                self._last = None
+                self.triggers.clear()
+                self._shown = None
+            self.channel = channel
+            self.level = level
+            self.slope = slope
+            self.hysteresis = abs(hysteresis)
+            self.holdoff = int(holdoff)
+            if length is not None:
+                self.length = int(length)
+            if pretrigger is not None:
+                self.pretrigger = int(pretrigger)
+
+    def disable(self):
+        self.configure(None, self.level, self.slope)
+
+    def setCapture(self, segments):
+        """Feed every trigger to segments, a Segments object, or None."""
+        with self._lock:
+            self.capture = segments
+
+    def _bands(self):
+        # thresholds of the +1 (above) and -1 (below) states
+        if self.slope == RISING:
+            return self.level, self.level - self.hysteresis
+        if self.slope == FALLING:
+            return self.level + self.hysteresis, self.level
+        return self.level + self.hysteresis/2., self.level - self.hysteresis/2.
+
+    def __call__(self, block):
+        """Scan a (channels, n) block, see Acquisition.add_sink()."""
+        with self._lock:
+            if self.channel is None or self.channel >= block.shape[0]:
+                return
+            n = block.shape[1]
+            if not n:
+                return
+            start = self.acquisition.written - n
+            x = block[self.channel]
+            for position in self.crossings(x):
+                self._fire(start + position)
+            self._last = x[-1]
+            if self.capture is not None:
+                self.capture.collect(self.acquisition)
+
+    def scan(self, x):
+        """Return the indices in x where the trigger conditions are met,
+        before applying holdoff, and update the arming state."""
+        above, below = self._bands()
+        state = np.zeros(len(x) + 1, dtype=np.int8)
+        state[0] = self._state
+        state[1:][x >= above] = 1
+        state[1:][x <= below] = -1
+        # carry the last state through the samples inside the band
+        index = np.where(state != 0, np.arange(len(state)), 0)
+        np.maximum.accumulate(index, out=index)
+        state = state[index]
+        self._state = state[-1]
+        change = state[1:]*state[:-1] < 0
+        if self.slope == RISING:
+            change &= state[1:] > 0
+        elif self.slope == FALLING:
+            change &= state[1:] < 0
+        return np.flatnonzero(change)
+
+    def crossings(self, x):
+        """Return the trigger points in x, in fractional samples, and update
+        the arming state. Holdoff is not applied."""
+        index = self.scan(x)
+        if not self.interpolate or not len(index):
+            return index
+        above, below = self._bands()
+        x1 = x[index].astype(np.float_)
+        first = x[0] if self._last is None else self._last
+        x0 = np.where(index > 0, x[index - 1], first).astype(np.float_)
+        # the threshold crossed: x0 is on the other side of it
+        threshold = np.where(x1 >= above, above, below)
+        step = np.where(x1 != x0, x1 - x0, 1.)
+        frac = np.where(x1 != x0, (threshold - x0)/step, 1.)
+        return index - 1 + np.clip(frac, 0., 1.)
+
+    def _fire(self, position):
+        if position < self._next:
+            return
+        self.triggers.append(position)
+        self.count += 1
+        self._next = position + max(self.holdoff, 1)
+        if self.capture is not None:
+            self.capture.add(position)
+
+    def frame(self):
+        """Return the newest complete triggered frame, or None.
+
+        The frame is a (channels, length) array starting pretrigger samples
+        before the trigger point. A frame is returned once only: None means
+        no new trigger since the last call.
+        """
+        with self._lock:
+            triggers = list(self.triggers)
+            shown = self._shown
+        written = self.acquisition.written
+        for position in reversed(triggers):
+            if shown is not None and position <= shown:
+                return None
+            start = position - self.pretrigger
+            first = int(np.floor(start))
+            frac = start - first
+            if frac and self.interpolate:
+                # LOBES - 1 samples before, LOBES after, for the resampling
+                if first + self.length + LOBES > written:
+                    # not acquired yet
+                    continue
+                frame = self.acquisition.read_at(first - LOBES + 1,
+                                                 self.length + 2*LOBES - 1)
+                if frame is not None:
+                    frame = utils.fractional_shift(frame, frac, LOBES)
+            else:
+                if first + self.length > written:
+                    continue
+                frame = self.acquisition.read_at(first, self.length)
+            if frame is None:
+                # overwritten already, older triggers are too
+                return None
+            self._shown = position
+            return frame
+        return None
+
+class Segments(object):
+    """Segmented memory: count triggered frames, captured back to back.
+
+    data[k] is the (channels, length) frame of the k-th trigger, starting
+    pretrigger samples before it, and positions[k] the trigger position
+    in the stream. Only the first filled frames are valid. The frames are
+    not resampled: frame k starts at the sample floor(positions[k]) -
+    pretrigger.
+    """
+    def __init__(self, count, channels, length, pretrigger=0,
+                 dtype=np.int32):
+        self.count = count
+        self.length = length
+        self.pretrigger = pretrigger
+        self.data = np.zeros((count, channels, length), dtype=dtype)
+        self.positions = np.zeros((count,), dtype=np.float64)
+        self.filled = 0
+        self.lost = 0            # triggers overwritten before being copied
+        self._pending = collections.deque()
+
+    @property
+    def done(self):
+        return self.filled == self.count
+
+    def add(self, position):
+        if self.filled + len(self._pending) < self.count:
+            self._pending.append(position)
+
+    def collect(self, acquisition):
+        """Copy the pending frames which are complete, oldest first."""
+        written = acquisition.written
+        while self._pending:
+            start = int(np.floor(self._pending[0])) - self.pretrigger
+            if start + self.length > written:
+                break
+            position = self._pending.popleft()
+            if acquisition.read_at(start, self.length,
+                                   self.data[self.filled]) is None:
+                self.lost += 1
+                continue
+            self.positions[self.filled] = position
+            self.filled += 1
+
+    def export(self, filename, rate):
+        """Write the captured frames to a CSV file.
+
+        The first column is the time from the trigger point, then one
+        column per segment and channel, named S<segment>_CH<channel>.
+        """
+        channels = self.data.shape[1]
+        t = (np.arange(self.length) - self.pretrigger)/float(rate)
+        headers = ["TIME"] + ["S%d_CH%d" % (k + 1, c + 1)
+                              for k in range(self.filled)
+                              for c in range(channels)]
+        data = self.data[:self.filled].reshape(-1, self.length)
+        csvlib.write_csv(filename, np.vstack((t, data)), headers)
+
+def test_trigger():
+    class Stream(object):
+        written = 0L
+    stream = Stream()
+    trigger = Trigger(stream)
+    trigger.configure(0, 0.5, RISING, hysteresis=0.2, length=10)
+    t = np.arange(1000)
+    x = np.sin(2*np.pi*t/100.)
+    # noise around the level must not retrigger
+    x[300:310] = [0.51, 0.49, 0.51, 0.49, 0.51, 0.49, 0.51, 0.49, 0.51, 0.49]
+    # feed in odd-sized blocks: crossings on block edges are found too
+    for i in range(0, 1000, 37):
+        block = x[np.newaxis, i:i+37]
+        stream.written += block.shape[1]
+        trigger(block)
+        # an empty block, e.g. from a probe at the end of a replay
+        trigger(x[np.newaxis, :0])
+    positions = np.array(trigger.triggers)
+    assert list(np.ceil(positions)) == [9, 109, 209, 300, 409, 509, 609, 709,
+                                        809, 909], positions
+    # sin(2 pi t/100) = 0.5 at t = 100/12
+    crossings = np.delete(positions, 3)
+    assert np.allclose(crossings % 100, 100/12., atol=0.01), crossings
+    trigger.configure(0, 0.5, RISING, hysteresis=0.2, holdoff=150, length=10)
+    trigger._next = 0L
+    trigger.triggers.clear()
+    stream.written = 0L
+    for i in range(0, 1000, 37):
+        block = x[np.newaxis, i:i+37]
+        stream.written += block.shape[1]
+        trigger(block)
+    positions = list(np.ceil(trigger.triggers))
+    assert positions == [9, 209, 409, 609, 809], positions
+
+def test_aligned_frames():
+    class Stream(object):
+        written = 0L
+        def read_at(self, start, n, out=None):
+            return self.data[:, start:start+n].copy()
+    stream = Stream()
+    trigger = Trigger(stream)
+    trigger.configure(0, 0., RISING, hysteresis=0.1, length=40,
+                      pretrigger=10)
+    # a period that is not a whole number of samples: the crossings
+    # wander between the samples
+    t = np.arange(2000)
+    stream.data = np.sin(2*np.pi*t/37.3)[np.newaxis]
+    frames = []
+    for i in range(0, 2000, 50):
+        block = stream.data[:, i:i+50]
+        stream.written += block.shape[1]
+        trigger(block)
+        frame = trigger.frame()
+        if frame is not None:
+            frames.append(frame[0])
+    expected = np.sin(2*np.pi*(np.arange(40) - 10)/37.3)
+    assert len(frames) > 10
+    for frame in frames:
+        assert np.allclose(frame, expected, atol=0.01)
+
+def test_segments():
+    class Stream(object):
+        written = 0L
+        data = np.sin(2*np.pi*np.arange(1000)/100.)[np.newaxis]
+        def read_at(self, start, n, out=None):
+            if out is None:
+                out = np.empty((1, n))
+            out[:] = self.data[:, start:start+n]
+            return out
+    stream = Stream()
+    trigger = Trigger(stream)
+    trigger.configure(0, 0.5, RISING, hysteresis=0.2, length=20,
+                      pretrigger=5)
+    segments = Segments(3, 1, 20, 5, dtype=float)
+    trigger.setCapture(segments)
+    for i in range(0, 1000, 37):
+        block = stream.data[:, i:i+37]
+        stream.written += block.shape[1]
+        trigger(block)
+    assert segments.done
+    assert list(np.ceil(segments.positions)) == [9, 109, 209]
+    for k in range(3):
+        start = int(np.floor(segments.positions[k])) - 5
+        assert np.all(segments.data[k] == stream.data[:, start:start+20])
+
+if __name__ == '__main__':
+    test_trigger()
+    test_aligned_frames()
+    test_segments()
@@ -1,10 +1,76 @@
 import numpy as np
 
 def autocorrelation(x):
-    n = x.shape[0]
-    x = x - x.mean()
-    r = np.correlate(x, x, mode='full')[-n:]
-    return r/(x.var()*np.arange(n, 0, -1))
+    """Normalized autocorrelation along the last axis, lags 0 to n-1.
+
+    x may be a (channels, n) array: all channels are processed at once,
+    through zero-padded FFTs.
+    """
+    x = np.asarray(x, dtype=float)
+    n = x.shape[-1]
+    x = x - x.mean(axis=-1)[..., np.newaxis]
+    # pad to avoid circular wrap-around
+    nfft = 2**int(np.ceil(np.log2(2*n - 1)))
+    X = np.fft.rfft(x, nfft)
+    r = np.fft.irfft((X*np.conjugate(X)).real, nfft)[..., :n]
+    return r/(x.var(axis=-1)[..., np.newaxis]*np.arange(n, 0, -1))
+
+def fractional_shift(x, frac, lobes=4):
+    """Resample x along the last axis, between its samples.
+
+    Returns y, 2*lobes - 1 samples shorter than x, with
+    y[k] = x(k + lobes - 1 + frac), interpolated with a Lanczos kernel of
+    the given number of lobes. 0 <= frac < 1. x may be a (channels, n)
+    array.
+    """
+    x = np.asarray(x, dtype=float)
+    n = x.shape[-1] - 2*lobes + 1
+    d = np.arange(-lobes + 1, lobes + 1) - frac
+    h = np.sinc(d)*np.sinc(d/lobes)
+    h /= h.sum()
+    y = np.zeros(x.shape[:-1] + (n,))
+    for i in range(len(h)):
+        y += h[i]*x[..., i:i+n]
+    return y
+
+def minmax(x, buckets):
+    """Minimum and maximum of x over consecutive buckets of samples.
+
+    The last axis of x is cut in buckets of ceil(n/buckets) samples, the
+    last one possibly shorter, and reduced at once. Returns the (mins,
+    maxs) arrays, of shape x.shape[:-1] + (nbuckets,), with nbuckets <=
+    buckets.
+    """
+    x = np.asarray(x)
+    n = x.shape[-1]
+    size = max(-(-n//buckets), 1)
+    full = n//size
+    body = x[..., :full*size].reshape(x.shape[:-1] + (full, size))
+    mins, maxs = body.min(axis=-1), body.max(axis=-1)
+    if full*size < n:
+        tail = x[..., full*size:]
+        mins = np.concatenate((mins, tail.min(axis=-1)[..., np.newaxis]), axis=-1)
+        maxs = np.concatenate((maxs, tail.max(axis=-1)[..., np.newaxis]), axis=-1)
+    return mins, maxs
+
+def decimate(t, y, columns):
+    """Reduce curves to about two points per pixel column, for drawing.
+
+    y may be a (curves, n) array sampled at t. Every bucket of samples
+    drawn in the same column is replaced by its minimum and maximum, at
+    the time of its first sample, so that the peaks are exact. Returns
+    (t, y), unchanged if there are no more than 2*columns samples.
+    """
+    n = y.shape[-1]
+    if n <= 2*columns:
+        return t, y
+    mins, maxs = minmax(y, columns)
+    size = -(-n//columns)
+    tt = np.repeat(t[::size], 2)
+    yy = np.empty(y.shape[:-1] + (len(tt),))
+    yy[..., 0::2] = mins
+    yy[..., 1::2] = maxs
+    return tt, yy
 
 def test_autocorrelation():
     x = np.random.rand(100) + np.random.rand()
@@ -13,5 +79,49 @@ def test_autocorrelation():
     r = autocorrelation(x)
     assert np.allclose(r*x.var()*np.arange(n, 0, -1), [(x[:n-k]*x[-(n-k):]).sum() for k in range(n)])
 
+def test_autocorrelation_channels():
+    x = np.random.rand(3, 100)
+    r = autocorrelation(x)
+    assert r.shape == x.shape
+    for c in range(3):
+        assert np.allclose(r[c], autocorrelation(x[c]))
+
+def test_fractional_shift():
+    t = np.arange(200)
+    x = np.vstack((np.sin(2*np.pi*t/50.), np.cos(2*np.pi*t/20.)))
+    y = fractional_shift(x, 0.3, 4)
+    assert y.shape == (2, 193)
+    tt = t[:193] + 3 + 0.3
+    assert np.allclose(y[0], np.sin(2*np.pi*tt/50.), atol=1e-2)
+    assert np.allclose(y[1], np.cos(2*np.pi*tt/20.), atol=1e-2)
+    assert np.allclose(fractional_shift(x, 0.0, 4), x[:, 3:-4])
+
+def test_minmax():
+    x = np.random.rand(2, 1003)
+    mins, maxs = minmax(x, 100)
+    # buckets of 11 samples, the last one of 2
+    assert mins.shape == (2, 92)
+    assert np.all(mins[:, 0] == x[:, :11].min(axis=-1))
+    assert np.all(maxs[:, -1] == x[:, 1001:].max(axis=-1))
+    assert mins.min() == x.min() and maxs.max() == x.max()
+    mins, maxs = minmax(x[0, :50], 100)
+    assert np.all(mins == x[0, :50]) and np.all(maxs == x[0, :50])
+
+def test_decimate():
+    t = np.arange(100000)*1e-5
+    y = np.random.randn(2, 100000)
+    y[1, 54321] = 100.
+    tt, yy = decimate(t, y, 800)
+    assert yy.shape == (2, 2*len(np.arange(0, 100000, 125)))
+    assert np.all(np.diff(tt) >= 0)
+    assert yy.max(axis=-1).tolist() == y.max(axis=-1).tolist()
+    assert yy.min(axis=-1).tolist() == y.min(axis=-1).tolist()
+    tt, yy = decimate(t[:1000], y[:, :1000], 800)
+    assert yy.shape == (2, 1000)
+
 if __name__ == '__main__':
     test_autocorrelation()
+    test_autocorrelation_channels()
+    test_fractional_shift()
+    test_minmax()
+    test_decimate()